@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+"""
+Time importing django_pylibmc.memcached, which should neither import pylibmc
+nor read settings, against importing Django's memcached backend alone.
+
+Each import runs in a new interpreter::
+
+    python -m benchmarks.import_time --runs 20
+"""
+from __future__ import print_function
+
+import argparse
+import subprocess
+import sys
+
+IMPORT = '''
+import sys, time
+start = time.time()
+import %s
+print(time.time() - start)
+print('pylibmc' in sys.modules)
+'''
+
+
+def time_import(module, runs):
+    """
+    Return the import times of `module` in seconds, and whether it imported
+    pylibmc.
+    """
+    times = []
+    imported_pylibmc = False
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, '-c', IMPORT % module])
+        seconds, pylibmc = output.decode().split()
+        times.append(float(seconds))
+        imported_pylibmc = imported_pylibmc or pylibmc == 'True'
+    return sorted(times), imported_pylibmc
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    for module in ('django.core.cache.backends.memcached', 'django_pylibmc.memcached', 'pylibmc'):
+        times, imported_pylibmc = time_import(module, args.runs)
+        print('%-40s median %6.1f ms, min %6.1f ms%s' % (
+            module, times[len(times) // 2] * 1000, times[0] * 1000,
+            ', imports pylibmc' if imported_pylibmc else ''))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+"""
+Measure the throughput and latency of the cache backend against the memcached
+stand-in from the tests, with reproducible latency and faults.
+
+For example, with 1 to 5 ms of latency, a 1% chance of connection resets and
+a 50 ms budget for each operation::
+
+    python -m benchmarks.throughput --latency 0.001 0.005 --reset-rate 0.01 --budget 0.05
+"""
+from __future__ import division, print_function
+
+import argparse
+import logging
+import time
+
+from django.conf import settings
+
+
+OPERATIONS = ('get', 'set', 'get_many', 'iter_many')
+
+
+def percentile(times, share):
+    return times[min(int(len(times) * share), len(times) - 1)]
+
+
+def run(cache, operation, ops, keys, batch_size, budget):
+    """
+    Run `operation` `ops` times, and return the sorted seconds each took and
+    the number that failed or missed.
+    """
+    times = []
+    failed = 0
+    for i in range(ops):
+        batch = [keys[(i * batch_size + j) % len(keys)] for j in range(batch_size)]
+        start = time.time()
+        if operation == 'get':
+            failed += cache.get(batch[0], budget=budget) is None
+        elif operation == 'set':
+            failed += not cache.set(batch[0], 'x' * 100, budget=budget)
+        elif operation == 'get_many':
+            failed += len(batch) - len(cache.get_many(batch, budget=budget))
+        else:
+            failed += len(batch) - len(list(cache.iter_many(batch, budget=budget)))
+        times.append(time.time() - start)
+    return sorted(times), failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--ops', type=int, default=1000, help='Operations of each kind.')
+    parser.add_argument('--keys', type=int, default=1000, help='Number of distinct keys.')
+    parser.add_argument('--batch-size', type=int, default=100, help='Keys per get_many and iter_many.')
+    parser.add_argument('--latency', type=float, nargs=2, metavar=('LOW', 'HIGH'),
+                        help='Uniform latency of the server, in seconds.')
+    parser.add_argument('--reset-rate', type=float, default=0.0)
+    parser.add_argument('--partial-rate', type=float, default=0.0)
+    parser.add_argument('--budget', type=float, help='Budget of each operation, in seconds.')
+    parser.add_argument('--binary', action='store_true', help='Use the binary protocol.')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    settings.configure()
+    # Failures are counted, not logged.
+    logging.getLogger('django.pylibmc').addHandler(logging.NullHandler())
+    from django_pylibmc.memcached import PyLibMCCache
+    from tests.fake_memcached import FakeMemcachedServer
+
+    with FakeMemcachedServer(seed=args.seed) as server:
+        cache = PyLibMCCache(server.location, {'BINARY': args.binary, 'OPTIONS': {'retry_timeout': 1}})
+        keys = ['key:%d' % i for i in range(args.keys)]
+        cache.set_many(dict.fromkeys(keys, 'x' * 100))
+        server.latency = tuple(args.latency) if args.latency else None
+        server.reset_rate = args.reset_rate
+        server.partial_rate = args.partial_rate
+
+        print('%-10s %10s %10s %10s %10s %8s' % ('operation', 'ops/s', 'p50 ms', 'p99 ms', 'max ms', 'failed'))
+        for operation in OPERATIONS:
+            batch_size = args.batch_size if operation in ('get_many', 'iter_many') else 1
+            times, failed = run(cache, operation, args.ops, keys, batch_size, args.budget)
+            print('%-10s %10.0f %10.2f %10.2f %10.2f %7.1f%%' % (
+                operation, len(times) / sum(times), percentile(times, 0.5) * 1000,
+                percentile(times, 0.99) * 1000, times[-1] * 1000, failed / (len(times) * batch_size) * 100))
+
+
+if __name__ == '__main__':
+    main()
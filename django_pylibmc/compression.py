@@ -0,0 +1,138 @@
+"""
+Adaptive compression for the pylibmc cache backend.
+
+pylibmc compresses every value longer than `min_compress_len`, whether or not
+it compresses well. `AdaptiveCompression` samples the compression ratio of
+values by key namespace and value type, stops compressing the kinds of values
+that don't shrink, and picks the compression level by payload size.
+"""
+import random
+import zlib
+from threading import Lock
+
+from django.utils import six
+
+try:    # Use the same idiom as in cache backends
+    from django.utils.six.moves import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+# Value types pylibmc stores as they are, without pickling
+RAW_TYPES = (six.binary_type, six.text_type)
+
+# pylibmc never compresses these
+UNCOMPRESSED_TYPES = six.integer_types + (float, type(None))
+
+
+class AdaptiveCompression(object):
+    """
+    Compression decisions for values, by key namespace and value type.
+
+    Each kind of value is sampled: the first `min_samples` values, and then
+    `sample_rate` of them, are serialized to measure their size, and those
+    above `min_compress_len` are compressed with zlib to measure their ratio
+    (compressed over original size). Once a kind has `min_samples` ratios,
+    it is only compressed if their average is at most `max_ratio`.
+
+    `levels` is a list of `(min_size, level)` pairs: payloads of at least
+    `min_size` bytes are compressed at `level` instead of `compress_level`.
+    By default, payloads of 512KiB or more use `zlib.Z_BEST_SPEED`.
+    """
+    # Weight of each new sample in the running averages
+    alpha = 0.2
+
+    def __init__(self, min_compress_len, compress_level, sample_rate=0.01,
+                 min_samples=10, max_ratio=0.9, levels=((512 * 1024, zlib.Z_BEST_SPEED),),
+                 max_kinds=1000):
+        self.min_compress_len = min_compress_len
+        self.compress_level = compress_level
+        self.sample_rate = sample_rate
+        self.min_samples = min_samples
+        self.max_ratio = max_ratio
+        self.levels = sorted(levels, reverse=True)
+        self.max_kinds = max_kinds
+        self._kinds = {}
+        self._lock = Lock()
+
+    def compress_kwargs(self, namespace, value):
+        """
+        Return the compression keyword arguments to store `value` with.
+        """
+        if not self.min_compress_len or isinstance(value, UNCOMPRESSED_TYPES):
+            return {'min_compress_len': 0}
+        if isinstance(value, RAW_TYPES) and len(value) < self.min_compress_len:
+            return {'min_compress_len': 0}
+
+        kind = (namespace, type(value).__name__)
+        stats = self._kinds.get(kind)
+        if stats is None:
+            # Kinds beyond max_kinds aren't measured, and are compressed as
+            # without adaptive compression.
+            if len(self._kinds) < self.max_kinds:
+                stats = self._sample(kind, value)
+        elif stats['sampled'] < self.min_samples or random.random() < self.sample_rate:
+            stats = self._sample(kind, value) or stats
+
+        size = len(value) if isinstance(value, RAW_TYPES) else 0
+        if stats is not None:
+            if stats['samples'] >= self.min_samples and stats['ratio'] > self.max_ratio:
+                return {'min_compress_len': 0}
+            size = size or stats['size']
+        return {
+            'min_compress_len': self.min_compress_len,
+            'compress_level': self.level_for(size),
+        }
+
+    def level_for(self, size):
+        for min_size, level in self.levels:
+            if size >= min_size:
+                return level
+        return self.compress_level
+
+    def _sample(self, kind, value):
+        if isinstance(value, six.binary_type):
+            payload = value
+        elif isinstance(value, RAW_TYPES):
+            payload = value.encode('utf-8')
+        else:
+            try:
+                payload = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            except Exception:
+                # Let pylibmc report unpicklable values
+                return None
+        size = len(payload)
+        if size >= self.min_compress_len:
+            ratio = float(len(zlib.compress(payload, zlib.Z_BEST_SPEED))) / size
+        else:
+            ratio = None
+
+        with self._lock:
+            stats = self._kinds.get(kind)
+            if stats is None:
+                if len(self._kinds) >= self.max_kinds:
+                    return None
+                stats = self._kinds[kind] = {'sampled': 0, 'size': size, 'samples': 0, 'ratio': 1.0}
+            stats['sampled'] += 1
+            stats['size'] += int(self._weight(stats['sampled']) * (size - stats['size']))
+            if ratio is not None:
+                stats['samples'] += 1
+                stats['ratio'] += self._weight(stats['samples']) * (ratio - stats['ratio'])
+        return stats
+
+    def _weight(self, count):
+        # A plain mean over the first samples, then a moving average
+        return max(self.alpha, 1.0 / count)
+
+    def stats(self):
+        """
+        Return the measurements and decisions, as a dict by
+        `(namespace, type name)`.
+        """
+        with self._lock:
+            kinds = [(kind, dict(stats)) for kind, stats in self._kinds.items()]
+        for kind, stats in kinds:
+            stats['compress'] = stats['size'] >= self.min_compress_len and (
+                stats['samples'] < self.min_samples or stats['ratio'] <= self.max_ratio)
+            stats['level'] = self.level_for(stats['size']) if stats['compress'] else None
+        return dict(kinds)
@@ -0,0 +1,55 @@
+"""
+Deadlines for cache operations.
+
+A deadline limits the time the cache operations of a thread may take, in
+total. Operations that start when too little of it is left are skipped and
+treated as misses instead of running late::
+
+    with deadline(0.05):
+        profile = cache.get('profile:%d' % pk)
+"""
+import time
+from contextlib import contextmanager
+from threading import local
+
+
+_local = local()
+
+
+def set_deadline(seconds):
+    """
+    Give the cache operations of this thread `seconds` from now, or less if
+    a deadline is already set.
+    """
+    deadline = time.time() + seconds
+    current = getattr(_local, 'deadline', None)
+    _local.deadline = deadline if current is None else min(current, deadline)
+
+
+def clear_deadline():
+    _local.deadline = None
+
+
+@contextmanager
+def deadline(seconds):
+    """
+    Give the cache operations in the block `seconds` in total.
+    """
+    previous = getattr(_local, 'deadline', None)
+    set_deadline(seconds)
+    try:
+        yield
+    finally:
+        _local.deadline = previous
+
+
+def remaining(budget=None):
+    """
+    Return the seconds left for an operation, the smaller of `budget` and
+    the time to the deadline of the thread, or None if there is neither.
+    """
+    deadline = getattr(_local, 'deadline', None)
+    if deadline is None:
+        return budget
+    left = deadline - time.time()
+    return left if budget is None else min(left, budget)
@@ -0,0 +1,75 @@
+"""
+Batched caching of rendered fragments.
+
+Instead of a `get` for each cached fragment of a page, fragments are added to
+a `FragmentBatch` as placeholders, all fetched with one `get_many` when the
+page is done, and the missing ones rendered and stored with one `set_many`::
+
+    batch = FragmentBatch(cache)
+    rows = [batch.add('row:%d' % row.pk, partial(render_row, row), 300) for row in rows]
+    html = batch.render(''.join(rows))
+"""
+import uuid
+from collections import OrderedDict
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+
+
+class FragmentBatch(object):
+    """
+    Fragments of `cache` to fetch at once.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.closed = False
+        # (key, render, timeout) by placeholder
+        self._fragments = OrderedDict()
+        self._token = uuid.uuid4().hex
+
+    def __len__(self):
+        return len(self._fragments)
+
+    def add(self, key, render, timeout=DEFAULT_TIMEOUT):
+        """
+        Return a placeholder for the fragment cached as `key`, which is
+        rendered by calling `render` if it is missing, and cached for
+        `timeout` seconds.
+        """
+        placeholder = '\x00fragment:%s:%d\x00' % (self._token, len(self._fragments))
+        self._fragments[placeholder] = (key, render, timeout)
+        return placeholder
+
+    def is_intact(self, output):
+        """
+        Whether each placeholder is in `output` as `add` returned it, and
+        nothing else looks like one, as after a filter changed it.
+        """
+        counts = [output.count(placeholder) for placeholder in self._fragments]
+        return all(counts) and output.lower().count(self._token) == sum(counts)
+
+    def render(self, output):
+        """
+        Return `output` with the placeholders replaced by their fragments.
+
+        Fragments can't be added once this is called; those rendered here
+        are cached on their own. Raises ValueError if the placeholders in
+        `output` aren't intact (see `is_intact`).
+        """
+        self.closed = True
+        if not self._fragments:
+            return output
+        if not self.is_intact(output):
+            raise ValueError('Fragment placeholders were changed before the batch was rendered.')
+        keys = [key for key, render, timeout in self._fragments.values()]
+        found = self.cache.get_many(keys)
+        # New fragments, grouped by their timeout
+        new_fragments = {}
+        for placeholder, (key, render, timeout) in self._fragments.items():
+            if key not in found:
+                found[key] = render()
+                new_fragments.setdefault(timeout, {})[key] = found[key]
+            output = output.replace(placeholder, found[key])
+        for timeout, fragments in new_fragments.items():
+            self.cache.set_many(fragments, timeout)
+        return output
@@ -0,0 +1,102 @@
+"""
+Hot key detection for the pylibmc cache backend.
+
+A small fraction of the keys read and written is counted in fixed-size
+Space-Saving summaries (Metwally, Agrawal and El Abbadi, "Efficient
+Computation of Frequent and Top-k Elements in Data Streams"), one for keys and
+one for key namespaces, so the memory and time spent stay bounded however
+much traffic there is.
+"""
+import random
+from threading import Lock
+
+
+class SpaceSaving(object):
+    """
+    The approximately most frequent of a stream of items, in `capacity`
+    counters.
+
+    Each count overestimates the real count of an item by at most its error.
+    Items more frequent than `1 / capacity` of the stream are always kept.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        # [count, error] by item
+        self._counters = {}
+
+    def __len__(self):
+        return len(self._counters)
+
+    def add(self, item, count=1):
+        counter = self._counters.get(item)
+        if counter is not None:
+            counter[0] += count
+        elif len(self._counters) < self.capacity:
+            self._counters[item] = [count, 0]
+        else:
+            # Replace the least frequent item, which the new one may have
+            # been counted as.
+            smallest = min(self._counters, key=lambda other: self._counters[other][0])
+            minimum = self._counters.pop(smallest)[0]
+            self._counters[item] = [minimum + count, minimum]
+
+    def top(self, limit=None):
+        """
+        Return the `(item, count, error)` of the `limit` most frequent items.
+        """
+        counters = sorted(self._counters.items(), key=lambda item: item[1][0], reverse=True)
+        return [(item, count, error) for item, (count, error) in counters[:limit]]
+
+    def clear(self):
+        self._counters = {}
+
+
+class HotKeySampler(object):
+    """
+    Counts a `sample_rate` sample of keys, by key and by namespace, in
+    `capacity` counters each.
+    """
+
+    def __init__(self, sample_rate=0.001, capacity=100):
+        self.sample_rate = sample_rate
+        self.keys = SpaceSaving(capacity)
+        self.namespaces = SpaceSaving(capacity)
+        self.sampled = 0
+        self._lock = Lock()
+
+    def sample(self, keys):
+        """
+        Return the part of `keys` picked to be counted.
+        """
+        rate = self.sample_rate
+        return [key for key in keys if random.random() < rate]
+
+    def add(self, key, namespace):
+        with self._lock:
+            self.sampled += 1
+            self.keys.add(key)
+            self.namespaces.add(namespace)
+
+    def report(self, limit=None):
+        """
+        Return the most frequent keys and namespaces, as lists of
+        `(item, estimated count, error)`, with counts and errors scaled back
+        up from the sample.
+        """
+        scale = 1.0 / self.sample_rate if self.sample_rate else 0
+        with self._lock:
+            keys = self.keys.top(limit)
+            namespaces = self.namespaces.top(limit)
+            sampled = self.sampled
+        return {
+            'sampled': sampled,
+            'keys': [(key, int(count * scale), int(error * scale)) for key, count, error in keys],
+            'namespaces': [(name, int(count * scale), int(error * scale)) for name, count, error in namespaces],
+        }
+
+    def clear(self):
+        with self._lock:
+            self.keys.clear()
+            self.namespaces.clear()
+            self.sampled = 0
@@ -0,0 +1,67 @@
+"""
+Show memcached server statistics, for capacity planning.
+"""
+from __future__ import division
+
+import json
+
+from django.core.cache import caches
+from django.core.management.base import BaseCommand, CommandError
+
+
+def percent(value):
+    return '-' if value is None else '%.1f%%' % (value * 100)
+
+
+def mebibytes(value):
+    return '%.1f MiB' % (value / 1024 / 1024)
+
+
+class Command(BaseCommand):
+    help = ('Shows the hit ratio, evictions, memory, connections and slab classes of '
+            'the memcached servers of a cache.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--cache', default='default',
+                            help='The cache alias to show statistics for (default: "default").')
+        parser.add_argument('--sample-key', action='append', dest='sample_keys',
+                            help='A key to estimate the item size of its namespace from. '
+                                 'Can be given several times.')
+        parser.add_argument('--json', action='store_true',
+                            help='Output the statistics as JSON.')
+
+    def handle(self, **options):
+        cache = caches[options['cache']]
+        if not hasattr(cache, 'server_stats'):
+            raise CommandError('The "%s" cache is not a django-pylibmc cache.' % options['cache'])
+        stats = cache.server_stats(sample_keys=options['sample_keys'])
+
+        if options['json']:
+            self.stdout.write(json.dumps(stats, indent=2, sort_keys=True))
+            return
+
+        self.write_summary('Ring (%d servers)' % len(stats['servers']), stats['ring'])
+        for server, summary in sorted(stats['servers'].items()):
+            self.write_summary(server, summary)
+        if stats.get('namespaces'):
+            self.stdout.write('Sampled namespaces')
+            self.stdout.write('  %-20s %8s %12s %12s' % ('namespace', 'samples', 'avg size', 'max size'))
+            for name, sizes in sorted(stats['namespaces'].items()):
+                self.stdout.write('  %-20s %8d %12d %12d' % (
+                    name or '(none)', sizes['samples'], sizes['avg_size'], sizes['max_size']))
+
+    def write_summary(self, title, summary):
+        self.stdout.write(title)
+        self.stdout.write('  hit ratio %s, evictions %d, items %d, connections %d' % (
+            percent(summary['hit_ratio']), summary['evictions'], summary['curr_items'],
+            summary['curr_connections']))
+        self.stdout.write('  memory %s of %s (%s)' % (
+            mebibytes(summary['bytes']), mebibytes(summary['limit_maxbytes']),
+            percent(summary['memory_fill'])))
+        if summary['slabs']:
+            self.stdout.write('  %5s %10s %12s %12s %8s %8s' % (
+                'class', 'chunk size', 'used chunks', 'total chunks', 'fill', 'evicted'))
+            for class_id, slab in sorted(summary['slabs'].items()):
+                self.stdout.write('  %5d %10d %12d %12d %8s %8d' % (
+                    class_id, slab.get('chunk_size', 0), slab.get('used_chunks', 0),
+                    slab.get('total_chunks', 0), percent(slab['fill']), slab.get('evicted', 0)))
@@ -7,48 +7,156 @@ settings.  The default is `False`, using the text protocol.
 pylibmc behaviors can be declared as a dict in `CACHES` backend `OPTIONS`
 setting.
 
+Values longer than `'MIN_COMPRESS_LEN'` bytes are compressed at
+`'COMPRESS_LEVEL'`, which default to the `PYLIBMC_MIN_COMPRESS_LEN` and
+`PYLIBMC_COMPRESS_LEVEL` settings. pylibmc is only imported, and settings
+only read, once the cache is used.
+
 Unlike the default Django caching backends, this backend lets you pass 0 as a
 timeout, which translates to an infinite timeout in memcached.
+
+Set `'NEGATIVE_TIMEOUT'` to a number of seconds to remember misses found by
+`get_or_set` and `get_or_load_many`, and `'LOCAL_MISS_FILTER'` to the maximum
+number of such misses to also remember in process memory.
+
+Set `'ADAPTIVE_COMPRESSION'` to True, or to a dict of `AdaptiveCompression`
+arguments, to only compress the kinds of values that compress well.
+
+Set `'HOT_KEYS'` to True, or to a dict of `HotKeySampler` arguments, to count
+a sample of the keys used and report the most frequent with `hot_keys()`.
+
+`get`, `get_many` and `set` take a `budget` of seconds, which is also limited
+by any deadline from `django_pylibmc.deadlines`. They use a client with
+timeouts that fit in what is left of it, from those in `'DEADLINE_TIERS'`,
+and are treated as misses when there is less than the smallest one left.
+
+Set `'WRITE_BEHIND'` to True, or to a dict of `WriteBehindQueue` arguments, for
+`set` and `set_many` to queue their writes for a background thread instead of
+waiting for them.
+
+`iter_many` fetches very large key sets in chunks of keys from one server,
+yielding the values as each chunk arrives.
+
+Set `'MIGRATE_FROM'` to a dict with the `'location'` of the previous servers,
+and optionally when the migration ends, as a Unix time `'until'` or a
+`'window'` of seconds from a Unix time `'start'`, to fall back to them on
+misses after resizing the ring.
 """
 import logging
+import math
+import re
+import socket
+import time
 import warnings
-from threading import local
+from itertools import islice
+from threading import Lock, local
 
 from django.conf import settings
 from django.core.cache.backends.base import InvalidCacheBackendError
 from django.core.cache.backends.memcached import BaseMemcachedCache, DEFAULT_TIMEOUT
+from django.utils import six
+from django.utils.encoding import force_bytes
+from django.utils.functional import cached_property
+from django.utils.six.moves import zip_longest
 
-try:
-    import pylibmc
-    from pylibmc import Error as MemcachedError
-except ImportError:
-    raise InvalidCacheBackendError('Could not import pylibmc.')
+from . import deadlines, stats
+from .compression import AdaptiveCompression
+from .hotkeys import HotKeySampler
+from .writebehind import WriteBehindQueue
 
 
 log = logging.getLogger('django.pylibmc')
 
 
-MIN_COMPRESS_LEN = getattr(settings, 'PYLIBMC_MIN_COMPRESS_LEN', 0)  # Disabled
-if MIN_COMPRESS_LEN > 0 and not pylibmc.support_compression:
-    MIN_COMPRESS_LEN = 0
-    warnings.warn('A minimum compression length was provided but pylibmc was '
-                  'not compiled with support for it.')
+# Stored in place of a value for keys confirmed to be missing. pylibmc stores
+# bytes as they are, so it is recognised without unpickling anything.
+MISS_SENTINEL = b'\x00django_pylibmc:miss\x00'
+
+# Use the cache's NEGATIVE_TIMEOUT
+DEFAULT_NEGATIVE_TIMEOUT = object()
+
+# Appended to keys to name the lock held while loading them
+LOCK_SUFFIX = ':lock'
+
+# Timeouts, in seconds, of the clients used for operations with a deadline
+DEADLINE_TIERS = (0.01, 0.05, 0.25, 1.0)
+
+# Process-wide state shared by the per-thread instances of a cache
+_shared = {}
+_shared_lock = Lock()
 
 
-COMPRESS_LEVEL = getattr(settings, 'PYLIBMC_COMPRESS_LEVEL', -1)  # zlib.Z_DEFAULT_COMPRESSION
-if not COMPRESS_LEVEL == -1:
-    if not pylibmc.support_compression:
-        warnings.warn('A compression level was provided but pylibmc was '
-                      'not compiled with support for it.')
+def import_pylibmc():
+    """
+    Import pylibmc, which loads libmemcached, on first use of a cache rather
+    than when this module is imported.
+    """
+    try:
+        import pylibmc
+    except ImportError:
+        raise InvalidCacheBackendError('Could not import pylibmc.')
+    return pylibmc
+
+
+def key_namespace(key):
+    """
+    Return the namespace of `key`: the part before the first colon, or an
+    empty string for keys without one.
+    """
+    return key.split(':', 1)[0] if ':' in key else ''
+
+
+def is_miss(value):
+    """
+    Return True if `value` is the marker stored for a confirmed miss.
+    """
+    return isinstance(value, bytes) and value == MISS_SENTINEL
+
+
+class MissFilter(object):
+    """
+    Keys recently confirmed to be missing, kept in process memory so that
+    repeated misses don't need a round trip to memcached.
+
+    The filter holds at most `max_entries` keys; when it is full, expired
+    keys are dropped, and if that isn't enough, all of them.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._expires = {}
+        self._lock = Lock()
+
+    def __contains__(self, key):
+        expires = self._expires.get(key)
+        if expires is None:
+            return False
+        if expires > time.time():
+            return True
+        self._expires.pop(key, None)
+        return False
+
+    def add(self, keys, timeout):
+        now = time.time()
+        keys = keys[:self.max_entries]
+        with self._lock:
+            if len(self._expires) + len(keys) > self.max_entries:
+                self._expires = {key: expires for key, expires in self._expires.items() if expires > now}
+                if len(self._expires) + len(keys) > self.max_entries:
+                    self._expires = {}
+            self._expires.update(dict.fromkeys(keys, now + timeout))
 
-# Keyword arguments to configure compression options
-COMPRESS_KWARGS = {
-    'min_compress_len': MIN_COMPRESS_LEN,
-    'compress_level': COMPRESS_LEVEL,
-}
+    def discard(self, keys):
+        for key in keys:
+            self._expires.pop(key, None)
+
+    def clear(self):
+        self._expires = {}
 
 
 class PyLibMCCache(BaseMemcachedCache):
+    # Seconds between checks for keys being loaded by another caller
+    lock_poll_interval = 0.05
 
     def __init__(self, server, params, username=None, password=None):
         import os
@@ -57,6 +165,24 @@ class PyLibMCCache(BaseMemcachedCache):
         self._username = os.environ.get('MEMCACHE_USERNAME', username or params.get('USERNAME'))
         self._password = os.environ.get('MEMCACHE_PASSWORD', password or params.get('PASSWORD'))
         self._server = os.environ.get('MEMCACHE_SERVERS', server)
+        self.negative_timeout = params.get('NEGATIVE_TIMEOUT')
+        self._miss_filter_size = int(params.get('LOCAL_MISS_FILTER', 0))
+        self._adaptive_compression = params.get('ADAPTIVE_COMPRESSION', False)
+        self._hot_keys = params.get('HOT_KEYS', False)
+        self._deadline_tiers = sorted(params.get('DEADLINE_TIERS', DEADLINE_TIERS), reverse=True)
+        self._write_behind = params.get('WRITE_BEHIND', False)
+        self._min_compress_len = params.get('MIN_COMPRESS_LEN')
+        self._compress_level = params.get('COMPRESS_LEVEL')
+        self._migration = params.get('MIGRATE_FROM')
+        if self._migration is not None:
+            old_servers = self._migration['location']
+            if isinstance(old_servers, six.string_types):
+                old_servers = re.split('[;,]', old_servers)
+            self._old_servers = old_servers
+            if 'window' in self._migration and 'start' not in self._migration:
+                # Each process would otherwise start its own window.
+                raise InvalidCacheBackendError("MIGRATE_FROM needs a 'start' with its 'window'.")
+        pylibmc = import_pylibmc()
         super(PyLibMCCache, self).__init__(self._server, params, library=pylibmc,
                                            value_not_found_exception=pylibmc.NotFound)
 
@@ -69,20 +195,395 @@ class PyLibMCCache(BaseMemcachedCache):
         if client:
             return client
 
+        client = self._create_client(self._options)
+        self._local.client = client
+
+        return client
+
+    def _create_client(self, behaviors, servers=None):
         client_kwargs = {'binary': self.binary}
         if self._username is not None and self._password is not None:
             client_kwargs.update({
                 'username': self._username,
                 'password': self._password
             })
-        client = self._lib.Client(self._servers, **client_kwargs)
-        if self._options:
-            client.behaviors = self._options
+        client = self._lib.Client(servers or self._servers, **client_kwargs)
+        if behaviors:
+            client.behaviors = behaviors
+        return client
 
-        self._local.client = client
+    @property
+    def _write_behind_queue(self):
+        if not self._write_behind:
+            return None
+        options = self._write_behind if isinstance(self._write_behind, dict) else {}
+        return self._shared_state('write_behind', lambda: WriteBehindQueue(
+            lambda: self._create_client(self._options), **options), sorted(options.items()))
+
+    def _client_within(self, budget=None, old=False):
+        """
+        Return a client whose timeouts fit in the time left for an operation
+        (see `deadlines.remaining`), or None if there isn't enough left.
+
+        With `old`, the client is of the servers being migrated from, and
+        None if there is no migration.
+        """
+        if old and self._old_cache is None:
+            return None
+        remaining = deadlines.remaining(budget)
+        if remaining is None:
+            return self._old_cache if old else self._cache
+        for tier in self._deadline_tiers:
+            if tier <= remaining:
+                break
+        else:
+            return None
+
+        clients = getattr(self._local, 'deadline_clients', None)
+        if clients is None:
+            clients = self._local.deadline_clients = {}
+        client = clients.get((tier, old))
+        if client is None:
+            behaviors = dict(self._options or {})
+            behaviors.update({
+                'connect_timeout': int(tier * 1000),  # Milliseconds
+                '_poll_timeout': int(tier * 1000),  # Milliseconds
+                'send_timeout': int(tier * 1000000),  # Microseconds
+                'receive_timeout': int(tier * 1000000),  # Microseconds
+            })
+            client = clients[tier, old] = self._create_client(behaviors, self._old_servers if old else None)
+        return client
+
+    def _shared_state(self, name, factory, params=None):
+        """
+        Return the process-wide `name` state of this cache, creating it with
+        `factory` on first use. `params` are the settings `factory` uses.
+
+        Django creates a cache instance per thread, so anything that should be
+        shared by the whole process can't live on the instance itself. Caches
+        with the same servers but different settings don't share state.
+        """
+        key = (name, tuple(self._servers), self.key_prefix, self.binary, self._username,
+               repr(sorted((self._options or {}).items())), repr(params))
+        try:
+            return _shared[key]
+        except KeyError:
+            with _shared_lock:
+                if key not in _shared:
+                    _shared[key] = factory()
+                return _shared[key]
+
+    @property
+    def _old_cache(self):
+        """
+        The client of the servers being migrated from, or None if there is
+        no migration or it has ended.
+        """
+        if self._migration is None:
+            return None
+        end = self._migration_end()
+        if end is not None and time.time() >= end:
+            return None
+        client = getattr(self._local, 'old_client', None)
+        if client is None:
+            client = self._local.old_client = self._create_client(self._options, self._old_servers)
+        return client
+
+    def _migration_end(self):
+        if 'until' in self._migration:
+            return self._migration['until']
+        if 'window' in self._migration:
+            return self._migration['start'] + self._migration['window']
+        return None
+
+    def _migrate(self, made_keys, budget=None):
+        """
+        Fetch `made_keys`, missing from the cache, from the servers being
+        migrated from, and copy the values found to the current ones.
+
+        Returns a dict of the values found by made key.
+        """
+        if not made_keys:
+            return {}
+        old_client = self._client_within(budget, old=True)
+        if old_client is None:
+            return {}
+        try:
+            found = old_client.get_multi(list(made_keys))
+        except self._lib.Error as e:
+            log.error('MemcachedError: %s', e, exc_info=True)
+            return {}
+        found = {made_key: value for made_key, value in found.items() if not is_miss(value)}
+        client = self._client_within(budget) if found else None
+        if client is not None:
+            timeout = self.get_backend_timeout(self._migration.get('timeout', DEFAULT_TIMEOUT))
+            try:
+                # Values written since are newer than the copies.
+                client.add_multi(found, timeout, **self._default_compress_kwargs)
+            except self._lib.Error as e:
+                log.error('MemcachedError: %s', e, exc_info=True)
+        return found
+
+    @property
+    def _miss_filter(self):
+        if not self._miss_filter_size:
+            return None
+        return self._shared_state('miss_filter', lambda: MissFilter(self._miss_filter_size),
+                                  self._miss_filter_size)
+
+    @cached_property
+    def _default_compress_kwargs(self):
+        """
+        The compression keyword arguments from the cache settings, or the
+        global ones.
+        """
+        min_compress_len = self._min_compress_len
+        if min_compress_len is None:
+            min_compress_len = getattr(settings, 'PYLIBMC_MIN_COMPRESS_LEN', 0)  # Disabled
+        if min_compress_len > 0 and not self._lib.support_compression:
+            min_compress_len = 0
+            warnings.warn('A minimum compression length was provided but pylibmc was '
+                          'not compiled with support for it.')
+
+        compress_level = self._compress_level
+        if compress_level is None:
+            compress_level = getattr(settings, 'PYLIBMC_COMPRESS_LEVEL', -1)  # zlib.Z_DEFAULT_COMPRESSION
+        if not compress_level == -1:
+            if not self._lib.support_compression:
+                warnings.warn('A compression level was provided but pylibmc was '
+                              'not compiled with support for it.')
+
+        return {
+            'min_compress_len': min_compress_len,
+            'compress_level': compress_level,
+        }
+
+    @property
+    def _compression(self):
+        if not self._adaptive_compression:
+            return None
+        options = self._adaptive_compression if isinstance(self._adaptive_compression, dict) else {}
+        compress_kwargs = self._default_compress_kwargs
+        return self._shared_state('compression', lambda: AdaptiveCompression(
+            compress_kwargs['min_compress_len'], compress_kwargs['compress_level'], **options),
+            (sorted(compress_kwargs.items()), sorted(options.items())))
+
+    def _compress_kwargs(self, key, value):
+        """
+        Return the compression keyword arguments to store `value` under `key`
+        (the key as given, before `make_key`).
+        """
+        compression = self._compression
+        if compression is None:
+            return self._default_compress_kwargs
+        return compression.compress_kwargs(key_namespace(key), value)
+
+    def compression_stats(self):
+        """
+        Return the adaptive compression measurements and decisions, as a dict
+        by `(namespace, type name)`, or None if adaptive compression is off.
+        """
+        compression = self._compression
+        if compression is None:
+            return None
+        return compression.stats()
+
+    def server_stats(self, sample_keys=None):
+        """
+        Return statistics of the memcached servers, for capacity planning.
+
+        The summary of each server (hit ratio, evictions, memory, connections
+        and slab classes) is under 'servers', by server, and their combination
+        across the ring under 'ring'. If `sample_keys` are given, the item
+        sizes of their namespaces, estimated from their values, are under
+        'namespaces'.
+        """
+        general = {}
+        try:
+            for name, values in self._cache.get_stats():
+                if isinstance(name, bytes):
+                    name = name.decode('utf-8')
+                # libmemcached names servers "<host>:<port> (<index>)"
+                general[stats.parse_server(name.rsplit(' (', 1)[0])] = values
+        except self._lib.Error as e:
+            log.error('MemcachedError: %s', e, exc_info=True)
+
+        servers = {}
+        for server in self._servers:
+            try:
+                slabs = stats.slab_classes(stats.read_stats(server, 'slabs'),
+                                           stats.read_stats(server, 'items'))
+            except (socket.error, ValueError) as e:
+                log.warning('Could not read the slab statistics of %s: %s', server, e)
+                slabs = {}
+            servers[server] = stats.server_summary(general.get(stats.parse_server(server), {}), slabs)
+
+        result = {
+            'servers': servers,
+            'ring': stats.ring_summary(servers),
+        }
+        if sample_keys is not None:
+            result['namespaces'] = stats.namespace_sizes(self.get_many(sample_keys), key_namespace)
+        return result
+
+    @property
+    def _hot_key_sampler(self):
+        if not self._hot_keys:
+            return None
+        options = self._hot_keys if isinstance(self._hot_keys, dict) else {}
+        return self._shared_state('hot_keys', lambda: HotKeySampler(**options), sorted(options.items()))
+
+    def _sample_keys(self, keys, version=None):
+        """
+        Count a sample of `keys` for hot key detection. `version` is either
+        the version of all the keys, or a dict of versions by key.
+        """
+        if not self._hot_keys:
+            return
+        sampler = self._hot_key_sampler
+        for key in sampler.sample(keys):
+            key_version = version.get(key) if isinstance(version, dict) else version
+            sampler.add(self.make_key(key, version=key_version), key_namespace(key))
+
+    def hot_keys(self, limit=20):
+        """
+        Return the most used keys and namespaces seen by this process, or None
+        if hot key detection is off.
+
+        The result has the `limit` most used keys, with their estimated use
+        count, the maximum overestimation of that count and the server they
+        are on, under 'keys', and the same for namespaces, without servers,
+        under 'namespaces'.
+        """
+        sampler = self._hot_key_sampler
+        if sampler is None:
+            return None
+        report = sampler.report(limit)
+        return {
+            'sampled': report['sampled'],
+            'keys': [
+                {'key': key, 'count': count, 'error': error, 'server': self.server_for_key(key)}
+                for key, count, error in report['keys']
+            ],
+            'namespaces': [
+                {'namespace': name, 'count': count, 'error': error}
+                for name, count, error in report['namespaces']
+            ],
+        }
 
+    def flush_writes(self, timeout=None):
+        """
+        Wait for the writes queued by `WRITE_BEHIND` to be done, for up to
+        `timeout` seconds (by default its `flush_timeout`).
+
+        Returns True if they all were.
+        """
+        queue = self._write_behind_queue
+        if queue is None:
+            return True
+        return queue.flush(timeout)
+
+    def server_for_key(self, made_key):
+        """
+        Return the server `made_key` (a key from `make_key`) is stored on.
+        """
+        try:
+            # pylibmc hashes keys to the index of their server.
+            index = self._cache.hash(made_key)
+        except self._lib.Error as e:
+            log.error('MemcachedError: %s', e, exc_info=True)
+            return None
+        if 0 <= index < len(self._servers):
+            return self._servers[index]
+        return None
+
+    def _discard_writes(self, keys, version=None):
+        """
+        Drop the queued writes of `keys`, so they don't bring back the values
+        of deleted keys.
+        """
+        queue = self._write_behind_queue
+        if queue is not None:
+            queue.discard([self.make_key(key, version=version) for key in keys])
+
+    def _delete_old(self, keys, version=None, budget=None):
+        """
+        Delete `keys` from the servers being migrated from too, so they
+        aren't copied back.
+        """
+        old_client = self._client_within(budget, old=True)
+        if old_client is not None:
+            try:
+                old_client.delete_multi([self.make_key(key, version=version) for key in keys])
+            except self._lib.Error as e:
+                log.error('MemcachedError: %s', e, exc_info=True)
+
+    def _forget_misses(self, keys, version=None):
+        """
+        Drop `keys` from the local miss filter, before writing them.
+        """
+        miss_filter = self._miss_filter
+        if miss_filter is not None:
+            miss_filter.discard([self.make_key(key, version=version) for key in keys])
+
+    @property
+    def _misses_stored(self):
+        """
+        Whether misses may be stored in memcached, because negative caching
+        is configured or this process used it.
+        """
+        return self.negative_timeout is not None or self._shared_state('misses_stored', dict).get('misses_stored')
+
+    @property
+    def _cas_client(self):
+        """
+        A client that can compare and swap, or None if there is none.
+
+        pylibmc's `gets` leaves binary protocol connections unusable, so this
+        client uses the text protocol, which memcached accepts on the same
+        port. That isn't possible with SASL, which needs the binary protocol.
+        """
+        if self.binary and self._username is not None and self._password is not None:
+            return None
+        client = getattr(self._local, 'cas_client', None)
+        if client is None:
+            client = self._local.cas_client = self._lib.Client(self._servers)
+            client.behaviors = dict(self._options or {}, cas=True)
         return client
 
+    def _replace_miss(self, made_key, value, timeout):
+        """
+        Store `value` under `made_key` if it holds a remembered miss, and
+        return whether it did.
+        """
+        client = self._cas_client
+        if client is None:
+            return False
+        # pylibmc's gets sometimes sends a corrupted key when given text.
+        made_key = force_bytes(made_key)
+        current, cas = client.gets(made_key)
+        if cas is None or not is_miss(current):
+            return False
+        # cas takes no compression arguments, so this value isn't compressed.
+        return client.cas(made_key, value, cas, timeout)
+
+    def _remember_misses(self, made_keys, negative_timeout, store=True):
+        """
+        Record `made_keys` as confirmed misses in the local miss filter, and
+        in memcached too if `store` is True.
+        """
+        self._shared_state('misses_stored', dict)['misses_stored'] = True
+        client = self._client_within() if store else None
+        if client is not None:
+            try:
+                client.add_multi(dict.fromkeys(made_keys, MISS_SENTINEL),
+                                 self.get_backend_timeout(negative_timeout))
+            except self._lib.Error as e:
+                log.error('MemcachedError: %s', e, exc_info=True)
+        miss_filter = self._miss_filter
+        if miss_filter is not None and negative_timeout:
+            miss_filter.add(made_keys, negative_timeout)
+
     def get_backend_timeout(self, timeout=DEFAULT_TIMEOUT):
         """
         Special case timeout=0 to allow for infinite timeouts.
@@ -93,71 +594,434 @@ class PyLibMCCache(BaseMemcachedCache):
         return super(PyLibMCCache, self).get_backend_timeout(timeout)
 
     def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self._sample_keys([key], version=version)
+        self._forget_misses([key], version=version)
+        self._delete_old([key], version=version)
+        client = self._client_within()
+        if client is None:
+            return False
+        compress_kwargs = self._compress_kwargs(key, value)
         key = self.make_key(key, version=version)
         try:
-            return self._cache.add(key, value,
-                                   self.get_backend_timeout(timeout),
-                                   **COMPRESS_KWARGS)
-        except pylibmc.ServerError:
+            added = client.add(key, value,
+                               self.get_backend_timeout(timeout),
+                               **compress_kwargs)
+            # A remembered miss doesn't count as a value. The compare and swap
+            # client has no deadline timeouts, so it isn't used with a deadline.
+            if not added and self._misses_stored and client is self._cache:
+                added = self._replace_miss(key, value, self.get_backend_timeout(timeout))
+            return added
+        except self._lib.ServerError:
             log.error('ServerError saving %s (%d bytes)', key, len(str(value)),
                       exc_info=True)
             return False
-        except MemcachedError as e:
+        except self._lib.Error as e:
             log.error('MemcachedError: %s', e, exc_info=True)
             return False
 
-    def get(self, key, default=None, version=None):
+    def get(self, key, default=None, version=None, budget=None):
+        self._sample_keys([key], version=version)
+        client = self._client_within(budget)
+        if client is None:
+            return default
+        made_key = self.make_key(key, version=version)
         try:
-            return super(PyLibMCCache, self).get(key, default, version)
-        except MemcachedError as e:
+            value = client.get(made_key)
+        except self._lib.Error as e:
             log.error('MemcachedError: %s', e, exc_info=True)
             return default
+        if value is None:
+            value = self._migrate([made_key], budget).get(made_key)
+        if value is None or is_miss(value):
+            return default
+        return value
 
-    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None, budget=None):
+        self._sample_keys([key], version=version)
+        self._forget_misses([key], version=version)
+        # An older value left there would be copied back if this one expires.
+        self._delete_old([key], version=version, budget=budget)
+        queue = self._write_behind_queue
+        if queue is not None:
+            made_key = self.make_key(key, version=version)
+            return not queue.put({made_key: value}, self.get_backend_timeout(timeout),
+                                 self._compress_kwargs(key, value))
+        client = self._client_within(budget)
+        if client is None:
+            return False
+        compress_kwargs = self._compress_kwargs(key, value)
         key = self.make_key(key, version=version)
         try:
-            return self._cache.set(key, value,
-                                   self.get_backend_timeout(timeout),
-                                   **COMPRESS_KWARGS)
-        except pylibmc.ServerError:
+            return client.set(key, value,
+                              self.get_backend_timeout(timeout),
+                              **compress_kwargs)
+        except self._lib.ServerError:
             log.error('ServerError saving %s (%d bytes)', key, len(str(value)),
                       exc_info=True)
             return False
-        except MemcachedError as e:
+        except self._lib.Error as e:
             log.error('MemcachedError: %s', e, exc_info=True)
             return False
 
-    def delete(self, *args, **kwargs):
+    def delete(self, key, version=None):
+        self._forget_misses([key], version=version)
+        self._discard_writes([key], version=version)
+        self._delete_old([key], version=version)
+        client = self._client_within()
+        if client is None:
+            return False
         try:
-            return super(PyLibMCCache, self).delete(*args, **kwargs)
-        except MemcachedError as e:
+            return client.delete(self.make_key(key, version=version))
+        except self._lib.Error as e:
             log.error('MemcachedError: %s', e, exc_info=True)
             return False
 
-    def get_many(self, *args, **kwargs):
+    def get_many(self, keys, version=None, budget=None):
+        keys = list(keys)
+        self._sample_keys(keys, version=version)
+        client = self._client_within(budget)
+        if client is None:
+            return {}
+        made_keys = {self.make_key(key, version=version): key for key in keys}
         try:
-            return super(PyLibMCCache, self).get_many(*args, **kwargs)
-        except MemcachedError as e:
+            values = client.get_multi(list(made_keys))
+        except self._lib.Error as e:
             log.error('MemcachedError: %s', e, exc_info=True)
             return {}
+        values.update(self._migrate([made_key for made_key in made_keys if made_key not in values], budget))
+        return {made_keys[made_key]: value for made_key, value in values.items() if not is_miss(value)}
+
+    def iter_many(self, keys, chunk_size=100, version=None, budget=None):
+        """
+        Fetch `keys` in chunks of at most `chunk_size` keys stored on the same
+        server, and yield the `(key, value)` pairs found as each chunk is
+        fetched. Each chunk is given `budget` seconds.
+
+        Unlike `get_many`, only `chunk_size` keys per server and one chunk of
+        values are held at a time, and the first values are available once
+        one server has replied.
+        """
+        keys = iter(keys)
+        window_size = chunk_size * len(self._servers)
+        while True:
+            window = list(islice(keys, window_size))
+            if not window:
+                return
+            self._sample_keys(window, version=version)
+            for made_keys in self._server_chunks(window, chunk_size, version):
+                client = self._client_within(budget)
+                if client is None:
+                    return
+                try:
+                    values = client.get_multi(list(made_keys))
+                except self._lib.Error as e:
+                    log.error('MemcachedError: %s', e, exc_info=True)
+                    continue
+                values.update(self._migrate([made_key for made_key in made_keys if made_key not in values], budget))
+                for made_key, value in values.items():
+                    if not is_miss(value):
+                        yield made_keys[made_key], value
+
+    def _server_chunks(self, keys, chunk_size, version=None):
+        """
+        Split `keys` into dicts of at most `chunk_size` original keys by made
+        key, all stored on the same server, taking turns between servers.
+        """
+        by_server = {}
+        for key in keys:
+            made_key = self.make_key(key, version=version)
+            index = 0
+            if len(self._servers) > 1:
+                try:
+                    # pylibmc hashes keys to the index of their server.
+                    index = self._cache.hash(made_key)
+                except self._lib.Error:
+                    pass
+            by_server.setdefault(index, []).append((made_key, key))
+        chunks = [
+            [dict(made_keys[i:i + chunk_size]) for i in range(0, len(made_keys), chunk_size)]
+            for _, made_keys in sorted(by_server.items())
+        ]
+        return [chunk for turn in zip_longest(*chunks) for chunk in turn if chunk is not None]
 
-    def set_many(self, *args, **kwargs):
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        self._sample_keys(data, version=version)
+        self._forget_misses(data, version=version)
+        self._delete_old(data, version=version)
+        queue = self._write_behind_queue
+        if queue is not None:
+            made_keys = {self.make_key(key, version=version): key for key in data}
+            dropped = queue.put({made_key: data[key] for made_key, key in made_keys.items()},
+                                self.get_backend_timeout(timeout), {})
+            return [made_keys[made_key] for made_key in dropped]
+        client = self._client_within()
+        if client is None:
+            return list(data)
+        made_keys = {self.make_key(key, version=version): key for key in data}
         try:
-            return super(PyLibMCCache, self).set_many(*args, **kwargs)
-        except MemcachedError as e:
+            failed = client.set_multi({made_key: data[key] for made_key, key in made_keys.items()},
+                                      self.get_backend_timeout(timeout))
+            return [made_keys[made_key] for made_key in failed]
+        except self._lib.Error as e:
             log.error('MemcachedError: %s', e, exc_info=True)
             return False
 
-    def delete_many(self, *args, **kwargs):
+    def delete_many(self, keys, version=None):
+        keys = list(keys)
+        self._forget_misses(keys, version=version)
+        self._discard_writes(keys, version=version)
+        self._delete_old(keys, version=version)
+        client = self._client_within()
+        if client is None:
+            return False
         try:
-            return super(PyLibMCCache, self).delete_many(*args, **kwargs)
-        except MemcachedError as e:
+            return client.delete_multi([self.make_key(key, version=version) for key in keys])
+        except self._lib.Error as e:
             log.error('MemcachedError: %s', e, exc_info=True)
             return False
 
+    def clear(self):
+        miss_filter = self._miss_filter
+        if miss_filter is not None:
+            miss_filter.clear()
+        queue = self._write_behind_queue
+        if queue is not None:
+            queue.discard()
+        old_cache = self._old_cache
+        if old_cache is not None:
+            try:
+                old_cache.flush_all()
+            except self._lib.Error as e:
+                log.error('MemcachedError: %s', e, exc_info=True)
+        return super(PyLibMCCache, self).clear()
+
+    def incr(self, key, delta=1, version=None):
+        made_key = self.make_key(key, version=version)
+        value = self._incr(made_key, delta)
+        if value is None and self._migrate([made_key]):
+            # Copy a counter still on the servers being migrated from.
+            value = self._incr(made_key, delta)
+        if value is None:
+            raise ValueError("Key '%s' not found" % made_key)
+        return value
+
+    def decr(self, key, delta=1, version=None):
+        return self.incr(key, -delta, version=version)
+
+    def _incr(self, made_key, delta):
+        """
+        Add `delta` to the counter under `made_key`, and return its new value,
+        or None if it is missing or there is no time left for it.
+        """
+        client = self._client_within()
+        if client is None:
+            return None
+        try:
+            # memcached doesn't support a negative delta
+            if delta < 0:
+                return client.decr(made_key, -delta)
+            return client.incr(made_key, delta)
+        except self._lib.NotFound:
+            return None
+
+    def get_or_set(self, key, default, timeout=DEFAULT_TIMEOUT, version=None,
+                   negative_timeout=DEFAULT_NEGATIVE_TIMEOUT):
+        """
+        Fetch a key from the cache, adding `default` (or the result of calling
+        it) if the key is missing.
+
+        With negative caching, a `default` of None is remembered as a miss for
+        `negative_timeout` seconds, during which None is returned without
+        calling `default` again.
+        """
+        if negative_timeout is DEFAULT_NEGATIVE_TIMEOUT:
+            negative_timeout = self.negative_timeout
+        if negative_timeout is None:
+            return super(PyLibMCCache, self).get_or_set(key, default, timeout=timeout, version=version)
+
+        self._sample_keys([key], version=version)
+        made_key = self.make_key(key, version=version)
+        miss_filter = self._miss_filter
+        if miss_filter is not None and made_key in miss_filter:
+            return None
+        client = self._client_within()
+        try:
+            value = client.get(made_key) if client is not None else None
+        except self._lib.Error as e:
+            log.error('MemcachedError: %s', e, exc_info=True)
+            value = None
+        if value is None:
+            value = self._migrate([made_key]).get(made_key)
+        if is_miss(value):
+            self._remember_misses([made_key], negative_timeout, store=False)
+            return None
+        if value is not None:
+            return value
+
+        if callable(default):
+            default = default()
+        if default is None:
+            self._remember_misses([made_key], negative_timeout)
+            return None
+        self.add(key, default, timeout=timeout, version=version)
+        # Fetch the value again in case another caller added one first.
+        return self.get(key, default, version=version)
+
+    def get_or_load_many(self, keys, loader, timeout=DEFAULT_TIMEOUT, version=None,
+                         negative_timeout=DEFAULT_NEGATIVE_TIMEOUT, lock_timeout=None):
+        """
+        Fetch `keys` from the cache, loading the missing ones with `loader`.
+
+        This takes one `get_multi` for all the keys, one call to `loader`
+        with the list of missing keys, which returns a dict of the values it
+        found, and one `set_multi` to store them. With negative caching, keys
+        the loader didn't return are remembered as misses for
+        `negative_timeout` seconds.
+
+        `version` is either the version of all the keys, or a dict of
+        versions by key.
+
+        With `lock_timeout`, the missing keys are locked for up to that many
+        seconds while they are loaded. Keys locked by another caller are
+        waited for instead of being loaded again. Those still missing once
+        their lock is gone are locked and loaded with another call to
+        `loader`, and those still locked after `lock_timeout` are loaded
+        without a lock.
+
+        Returns a dict of the keys that have a value.
+        """
+        if negative_timeout is DEFAULT_NEGATIVE_TIMEOUT:
+            negative_timeout = self.negative_timeout
+        miss_filter = self._miss_filter if negative_timeout is not None else None
+        keys = list(keys)
+        self._sample_keys(keys, version=version)
+
+        made_keys = {}
+        for key in keys:
+            key_version = version.get(key) if isinstance(version, dict) else version
+            made_key = self.make_key(key, version=key_version)
+            if miss_filter is None or made_key not in miss_filter:
+                made_keys[made_key] = key
+
+        result = {}
+        missing, _ = self._fetch_many(made_keys, result, negative_timeout)
+        if not missing:
+            return result
+        if lock_timeout is None or self._client_within() is None:
+            self._load_many(missing, loader, result, timeout, negative_timeout)
+            return result
+
+        # memcached expires in whole seconds; get_backend_timeout would turn
+        # less than a second into a lock that never expires.
+        lock_ttl = max(1, int(math.ceil(lock_timeout)))
+        # Don't wait past the deadline of the thread either.
+        deadline = time.time() + deadlines.remaining(lock_timeout)
+        while missing:
+            waiting = self._lock_and_load(missing, loader, result, timeout, negative_timeout, lock_ttl)
+            missing = {}
+            while waiting and not missing:
+                if time.time() >= deadline:
+                    self._load_many(waiting, loader, result, timeout, negative_timeout)
+                    return result
+                time.sleep(self.lock_poll_interval)
+                locks = [made_key + LOCK_SUFFIX for made_key in waiting]
+                waiting, locked = self._fetch_many(waiting, result, negative_timeout, locks)
+                # Keys whose lock is gone without a value are locked again,
+                # with those still locked.
+                if any(made_key + LOCK_SUFFIX not in locked for made_key in waiting):
+                    missing, waiting = waiting, {}
+        return result
+
+    def _lock_and_load(self, made_keys, loader, result, timeout, negative_timeout, lock_ttl):
+        """
+        Lock `made_keys`, a dict of original keys by made key, for `lock_ttl`
+        seconds, and load those locked into `result`.
+
+        Returns the part of `made_keys` locked by another caller.
+        """
+        locks = {made_key + LOCK_SUFFIX: made_key for made_key in made_keys}
+        client = self._client_within()
+        try:
+            locked_elsewhere = set(client.add_multi(dict.fromkeys(locks, 1), lock_ttl)) if client is not None else set()
+        except self._lib.Error as e:
+            log.error('MemcachedError: %s', e, exc_info=True)
+            locked_elsewhere = set()
+
+        owned = [lock for lock in locks if lock not in locked_elsewhere]
+        if owned:
+            try:
+                self._load_many({locks[lock]: made_keys[locks[lock]] for lock in owned},
+                                loader, result, timeout, negative_timeout)
+            finally:
+                # Locks left behind expire with their TTL.
+                client = self._client_within()
+                try:
+                    if client is not None:
+                        client.delete_multi(owned)
+                except self._lib.Error as e:
+                    log.error('MemcachedError: %s', e, exc_info=True)
+        return {locks[lock]: made_keys[locks[lock]] for lock in locked_elsewhere}
+
+    def _fetch_many(self, made_keys, result, negative_timeout, extra_keys=()):
+        """
+        Fetch `made_keys`, a dict of original keys by made key, into `result`,
+        along with `extra_keys` in the same request.
+
+        Returns the part of `made_keys` that wasn't found, and the set of
+        `extra_keys` that were.
+        """
+        client = self._client_within()
+        keys = list(made_keys) + list(extra_keys)
+        try:
+            found = client.get_multi(keys) if keys and client is not None else {}
+        except self._lib.Error as e:
+            log.error('MemcachedError: %s', e, exc_info=True)
+            found = {}
+        found_extra = {key for key in extra_keys if found.pop(key, None) is not None}
+        found.update(self._migrate([made_key for made_key in made_keys if made_key not in found]))
+
+        known_misses = []
+        for made_key, value in found.items():
+            if is_miss(value):
+                known_misses.append(made_key)
+            else:
+                result[made_keys[made_key]] = value
+        if known_misses and negative_timeout is not None:
+            self._remember_misses(known_misses, negative_timeout, store=False)
+        return {made_key: key for made_key, key in made_keys.items() if made_key not in found}, found_extra
+
+    def _load_many(self, made_keys, loader, result, timeout, negative_timeout):
+        """
+        Load `made_keys`, a dict of original keys by made key, with `loader`
+        into `result`, and store what was loaded.
+        """
+        loaded = loader(list(made_keys.values())) or {}
+        # New values, grouped by their compression arguments
+        new_values = {}
+        new_misses = []
+        for made_key, key in made_keys.items():
+            value = loaded.get(key)
+            if value is None:
+                new_misses.append(made_key)
+            else:
+                result[key] = value
+                compress_kwargs = tuple(sorted(self._compress_kwargs(key, value).items()))
+                new_values.setdefault(compress_kwargs, {})[made_key] = value
+        client = self._client_within()
+        for compress_kwargs, values in new_values.items() if client is not None else ():
+            try:
+                client.set_multi(values, self.get_backend_timeout(timeout),
+                                 **dict(compress_kwargs))
+            except self._lib.Error as e:
+                log.error('MemcachedError: %s', e, exc_info=True)
+        if new_misses and negative_timeout is not None:
+            self._remember_misses(new_misses, negative_timeout)
+
     def close(self, **kwargs):
         # Override BaseMemcachedCache since libmemcached manages its own connections,
         # and calling disconnect_all() resets the failover state and causes unnecessary
         # reconnects. Copied from Django's PyLibMCCache backend:
         # https://github.com/django/django/blob/1.11.9/django/core/cache/backends/memcached.py#L207-L210
+        # Django closes caches after each request, which mustn't wait for the
+        # write-behind queue shared by all of them.
         pass
@@ -0,0 +1,29 @@
+"""
+Middleware for the pylibmc cache backend.
+"""
+from django.conf import settings
+
+from .deadlines import clear_deadline, set_deadline
+
+try:
+    from django.utils.deprecation import MiddlewareMixin
+except ImportError:
+    # Django < 1.10
+    MiddlewareMixin = object
+
+
+class CacheDeadlineMiddleware(MiddlewareMixin):
+    """
+    Give the cache operations of each request `PYLIBMC_REQUEST_DEADLINE`
+    seconds in total.
+    """
+
+    def process_request(self, request):
+        clear_deadline()
+        seconds = getattr(settings, 'PYLIBMC_REQUEST_DEADLINE', None)
+        if seconds is not None:
+            set_deadline(seconds)
+
+    def process_response(self, request, response):
+        clear_deadline()
+        return response
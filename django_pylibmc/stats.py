@@ -0,0 +1,195 @@
+"""
+Memcached server statistics, for capacity planning.
+
+pylibmc's `get_stats` only returns the general statistics libmemcached knows
+about, so the slab and item statistics are read with the text protocol.
+"""
+from __future__ import division
+
+import re
+import socket
+from collections import defaultdict
+
+from django.utils import six
+
+try:    # Use the same idiom as in cache backends
+    from django.utils.six.moves import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+DEFAULT_PORT = 11211
+
+# Slab class statistics to combine across servers
+SLAB_TOTALS = ('total_pages', 'total_chunks', 'used_chunks', 'free_chunks', 'number', 'evicted')
+
+
+def parse_server(server):
+    """
+    Return the `(family, address)` to connect to a server given as in
+    `LOCATION`: a Unix socket path, `host`, `host:port` or `[ipv6]:port`.
+    """
+    if server.startswith('unix:'):
+        server = server[len('unix:'):]
+    if server.startswith('/'):
+        # libmemcached names sockets <path>:0
+        return socket.AF_UNIX, re.sub(r':\d+$', '', server)
+    if server.startswith('['):
+        host, _, port = server[1:].partition(']')
+        port = port.lstrip(':')
+    elif server.count(':') == 1:
+        host, port = server.split(':')
+    else:
+        host, port = server, ''
+    port = port.split(':')[0]  # Drop any weight
+    return socket.AF_INET, (host, int(port or DEFAULT_PORT))
+
+
+def read_stats(server, group=None, timeout=1.0):
+    """
+    Return the result of `stats <group>` on `server`, as a dict of strings.
+
+    Raises `socket.error` if the server can't be reached, and `ValueError` if
+    it doesn't accept the command (for instance when it requires SASL).
+    """
+    family, address = parse_server(server)
+    if family == socket.AF_UNIX:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        sock.connect(address)
+    else:
+        sock = socket.create_connection(address, timeout)
+    try:
+        sock.sendall(('stats %s\r\n' % group if group else 'stats\r\n').encode('ascii'))
+        data = b''
+        while not data.endswith(b'END\r\n'):
+            if data.endswith(b'\r\n') and data.split(b' ', 1)[0].rstrip() in (
+                    b'ERROR', b'CLIENT_ERROR', b'SERVER_ERROR'):
+                raise ValueError(data.strip().decode('ascii', 'replace'))
+            chunk = sock.recv(65536)
+            if not chunk:
+                raise socket.error('Connection closed by %s' % server)
+            data += chunk
+    finally:
+        sock.close()
+
+    stats = {}
+    for line in data.decode('ascii', 'replace').splitlines():
+        parts = line.split(' ', 2)
+        if len(parts) == 3 and parts[0] == 'STAT':
+            stats[parts[1]] = parts[2]
+    return stats
+
+
+def to_number(value):
+    """
+    Convert a statistic to an int or float if it is a number.
+    """
+    if isinstance(value, six.binary_type):
+        value = value.decode('ascii', 'replace')
+    for number in (int, float):
+        try:
+            return number(value)
+        except (TypeError, ValueError):
+            pass
+    return value
+
+
+def ratio(part, total):
+    return part / total if total else None
+
+
+def slab_classes(slabs, items):
+    """
+    Combine `stats slabs` and `stats items` into a dict of statistics by slab
+    class id.
+    """
+    classes = defaultdict(dict)
+    for name, value in slabs.items():
+        class_id, _, stat = name.partition(':')
+        if class_id.isdigit():
+            classes[int(class_id)][stat] = to_number(value)
+    for name, value in items.items():
+        parts = name.split(':', 2)  # items:<class id>:<stat>
+        if len(parts) == 3 and parts[1].isdigit():
+            classes[int(parts[1])][parts[2]] = to_number(value)
+    for stats in classes.values():
+        stats['fill'] = ratio(stats.get('used_chunks', 0), stats.get('total_chunks', 0))
+    return dict(classes)
+
+
+def server_summary(general, slabs):
+    """
+    Summarize the general statistics and slab classes of a server.
+    """
+    general = {name: to_number(value) for name, value in general.items()}
+    hits, misses = general.get('get_hits', 0), general.get('get_misses', 0)
+    return {
+        'hit_ratio': ratio(hits, hits + misses),
+        'get_hits': hits,
+        'get_misses': misses,
+        'evictions': general.get('evictions', 0),
+        'bytes': general.get('bytes', 0),
+        'limit_maxbytes': general.get('limit_maxbytes', 0),
+        'memory_fill': ratio(general.get('bytes', 0), general.get('limit_maxbytes', 0)),
+        'curr_items': general.get('curr_items', 0),
+        'curr_connections': general.get('curr_connections', 0),
+        'total_connections': general.get('total_connections', 0),
+        'slabs': slabs,
+    }
+
+
+def ring_summary(servers):
+    """
+    Combine the summaries of the servers of a ring.
+    """
+    totals = defaultdict(int)
+    slabs = defaultdict(lambda: defaultdict(int))
+    for summary in servers.values():
+        for stat in ('get_hits', 'get_misses', 'evictions', 'bytes', 'limit_maxbytes',
+                     'curr_items', 'curr_connections', 'total_connections'):
+            totals[stat] += summary[stat]
+        for class_id, stats in summary['slabs'].items():
+            slabs[class_id]['chunk_size'] = stats.get('chunk_size', 0)
+            for stat in SLAB_TOTALS:
+                slabs[class_id][stat] += stats.get(stat, 0)
+    ring = dict(totals)
+    ring['hit_ratio'] = ratio(totals['get_hits'], totals['get_hits'] + totals['get_misses'])
+    ring['memory_fill'] = ratio(totals['bytes'], totals['limit_maxbytes'])
+    ring['slabs'] = {}
+    for class_id, stats in slabs.items():
+        stats = dict(stats)
+        stats['fill'] = ratio(stats['used_chunks'], stats['total_chunks'])
+        ring['slabs'][class_id] = stats
+    return ring
+
+
+def value_size(value):
+    """
+    Estimate the stored size of `value`, as pylibmc serializes it.
+    """
+    if isinstance(value, six.binary_type):
+        return len(value)
+    if isinstance(value, six.text_type):
+        return len(value.encode('utf-8'))
+    if isinstance(value, six.integer_types + (bool,)):
+        return len(str(value))
+    return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+
+def namespace_sizes(values, namespace):
+    """
+    Estimate item sizes by namespace from `values`, a dict of sampled values
+    by key, with `namespace` returning the namespace of a key.
+    """
+    sizes = defaultdict(list)
+    for key, value in values.items():
+        sizes[namespace(key)].append(value_size(value))
+    return {
+        name: {
+            'samples': len(found),
+            'avg_size': sum(found) // len(found),
+            'max_size': max(found),
+        }
+        for name, found in sizes.items()
+    }
@@ -0,0 +1,175 @@
+"""
+Template fragment caching with one cache lookup per page.
+
+`{% batched_cache %}` takes the same arguments as Django's `{% cache %}`, and
+uses the same keys. Inside `{% fragment_batch %}`, fragments are fetched all
+at once when the end of the batch is rendered, and missing ones are stored
+all at once::
+
+    {% load pylibmc_fragments %}
+    {% fragment_batch %}
+        {% for item in items %}
+            {% batched_cache 500 item item.pk item.modified %}
+                .. some expensive processing ..
+            {% endbatched_cache %}
+        {% endfor %}
+    {% endfragment_batch %}
+"""
+from django.core.cache import InvalidCacheBackendError, caches
+from django.core.cache.utils import make_template_fragment_key
+from django.template import Library, Node, TemplateSyntaxError, VariableDoesNotExist
+
+from ..fragments import FragmentBatch
+
+register = Library()
+
+# The context variable of the batch being rendered
+BATCH_VARIABLE = '_pylibmc_fragment_batch'
+
+
+def resolve_cache(tag_name, cache_name, context):
+    if cache_name is None:
+        try:
+            return caches['template_fragments']
+        except InvalidCacheBackendError:
+            return caches['default']
+    try:
+        cache_name = cache_name.resolve(context)
+    except VariableDoesNotExist:
+        raise TemplateSyntaxError('"%s" tag got an unknown variable: %r' % (tag_name, cache_name.var))
+    try:
+        return caches[cache_name]
+    except InvalidCacheBackendError:
+        raise TemplateSyntaxError('Invalid cache name specified for %s tag: %r' % (tag_name, cache_name))
+
+
+def parse_using(parser, tokens, min_length):
+    """
+    Return `tokens` without a final `using="cachename"` argument, and the
+    cache name it gives.
+    """
+    if len(tokens) > min_length and tokens[-1].startswith('using='):
+        return tokens[:-1], parser.compile_filter(tokens[-1][len('using='):])
+    return tokens, None
+
+
+def snapshot(context):
+    """
+    Copy `context` as it is now, to render a fragment later.
+    """
+    values = context.flatten()
+    # {% for %} updates its forloop variable in place.
+    loop = values.get('forloop')
+    if isinstance(loop, dict):
+        loop = values['forloop'] = dict(loop)
+        while isinstance(loop.get('parentloop'), dict):
+            loop['parentloop'] = dict(loop['parentloop'])
+            loop = loop['parentloop']
+    return context.new(values)
+
+
+class FragmentBatchNode(Node):
+    def __init__(self, nodelist, cache_name):
+        self.nodelist = nodelist
+        self.cache_name = cache_name
+
+    def render(self, context):
+        batch = FragmentBatch(resolve_cache('fragment_batch', self.cache_name, context))
+        with context.push(**{BATCH_VARIABLE: batch}):
+            output = self.nodelist.render(context)
+        if batch.is_intact(output):
+            return batch.render(output)
+        # A filter changed placeholders, so render the fragments in place.
+        batch.closed = True
+        with context.push(**{BATCH_VARIABLE: None}):
+            return self.nodelist.render(context)
+
+
+class BatchedCacheNode(Node):
+    def __init__(self, nodelist, expire_time_var, fragment_name, vary_on, cache_name):
+        self.nodelist = nodelist
+        self.expire_time_var = expire_time_var
+        self.fragment_name = fragment_name
+        self.vary_on = vary_on
+        self.cache_name = cache_name
+
+    def render(self, context):
+        try:
+            expire_time = self.expire_time_var.resolve(context)
+        except VariableDoesNotExist:
+            raise TemplateSyntaxError(
+                '"batched_cache" tag got an unknown variable: %r' % self.expire_time_var.var)
+        if expire_time is not None:
+            try:
+                expire_time = int(expire_time)
+            except (ValueError, TypeError):
+                raise TemplateSyntaxError(
+                    '"batched_cache" tag got a non-integer timeout value: %r' % expire_time)
+        fragment_cache = resolve_cache('batched_cache', self.cache_name, context)
+
+        vary_on = [var.resolve(context) for var in self.vary_on]
+        cache_key = make_template_fragment_key(self.fragment_name, vary_on)
+        batch = context.get(BATCH_VARIABLE)
+        if batch is not None and not batch.closed and batch.cache is fragment_cache:
+            fragment_context = snapshot(context)
+            return batch.add(cache_key, lambda: self.nodelist.render(fragment_context), expire_time)
+
+        value = fragment_cache.get(cache_key)
+        if value is None:
+            value = self.nodelist.render(context)
+            fragment_cache.set(cache_key, value, expire_time)
+        return value
+
+
+@register.tag('fragment_batch')
+def do_fragment_batch(parser, token):
+    """
+    Fetch the `{% batched_cache %}` fragments inside with one lookup::
+
+        {% fragment_batch %}
+            .. {% batched_cache %} fragments ..
+        {% endfragment_batch %}
+
+    Optionally the cache to use may be specified thus::
+
+        {% fragment_batch using="cachename" %}
+
+    Only fragments using the same cache are batched.
+    """
+    nodelist = parser.parse(('endfragment_batch',))
+    parser.delete_first_token()
+    tokens, cache_name = parse_using(parser, token.split_contents(), 1)
+    if len(tokens) > 1:
+        raise TemplateSyntaxError("%r tag only accepts a using argument." % tokens[0])
+    return FragmentBatchNode(nodelist, cache_name)
+
+
+@register.tag('batched_cache')
+def do_batched_cache(parser, token):
+    """
+    Cache the contents of a template fragment, like `{% cache %}`, fetching
+    it with the other fragments of the enclosing `{% fragment_batch %}`::
+
+        {% batched_cache [expire_time] [fragment_name] [var1] [var2] .. %}
+            .. some expensive processing ..
+        {% endbatched_cache %}
+
+    Optionally the cache to use may be specified thus::
+
+        {% batched_cache ....  using="cachename" %}
+
+    Fragments in a batch are rendered after the rest of the batch, with a
+    copy of the context as it was at the tag.
+    """
+    nodelist = parser.parse(('endbatched_cache',))
+    parser.delete_first_token()
+    tokens = token.split_contents()
+    if len(tokens) < 3:
+        raise TemplateSyntaxError("'%r' tag requires at least 2 arguments." % tokens[0])
+    tokens, cache_name = parse_using(parser, tokens, 3)
+    return BatchedCacheNode(
+        nodelist, parser.compile_filter(tokens[1]),
+        tokens[2],  # fragment_name can't be a variable.
+        [parser.compile_filter(t) for t in tokens[3:]],
+        cache_name,
+    )
@@ -0,0 +1,161 @@
+"""
+Write-behind for the pylibmc cache backend.
+
+Writes are queued and done by a background thread, which merges them into
+`set_multi` batches. Repeated writes to a key that hasn't been written yet
+are coalesced into one, and writes are dropped when the queue is full.
+"""
+import atexit
+import logging
+import os
+import time
+from collections import OrderedDict
+from threading import Condition, Thread
+
+
+log = logging.getLogger('django.pylibmc')
+
+
+class WriteBehindQueue(object):
+    """
+    Writes waiting to be done by a background thread using a client from
+    `create_client`.
+
+    At most `max_pending` keys wait at a time, and at most `batch_size` are
+    written by each `set_multi`. `flush` waits up to `flush_timeout` seconds
+    by default.
+    """
+
+    def __init__(self, create_client, max_pending=10000, batch_size=100, flush_timeout=1.0):
+        self.create_client = create_client
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.flush_timeout = flush_timeout
+        self.dropped = 0
+        # (value, timeout, compression arguments) by key
+        self._pending = OrderedDict()
+        self._writing = 0
+        self._condition = Condition()
+        self._thread = None
+        self._pid = os.getpid()
+        atexit.register(self.flush)
+
+    def put(self, values, timeout, compress_kwargs):
+        """
+        Queue writing `values`, a dict of values by key, with `timeout` (in
+        seconds, as memcached takes it) and `compress_kwargs` as arguments of
+        `set_multi`.
+
+        Returns the list of keys dropped because the queue is full.
+        """
+        compress_kwargs = tuple(sorted(compress_kwargs.items()))
+        dropped = []
+        self._check_fork()
+        with self._condition:
+            self._start()
+            for key, value in values.items():
+                if key not in self._pending and len(self._pending) >= self.max_pending:
+                    dropped.append(key)
+                    continue
+                self._pending[key] = (value, timeout, compress_kwargs)
+            self.dropped += len(dropped)
+            self._condition.notify_all()
+        if dropped:
+            log.warning('Write-behind queue full, dropped %d writes', len(dropped))
+        return dropped
+
+    def discard(self, keys=None):
+        """
+        Drop the pending writes of `keys`, or all of them.
+        """
+        self._check_fork()
+        with self._condition:
+            if keys is None:
+                self._pending.clear()
+            else:
+                for key in keys:
+                    self._pending.pop(key, None)
+            self._condition.notify_all()
+
+    def __len__(self):
+        self._check_fork()
+        return len(self._pending)
+
+    def flush(self, timeout=None):
+        """
+        Wait for the pending writes to be done, for up to `timeout` seconds.
+
+        Returns True if they all were.
+        """
+        if timeout is None:
+            timeout = self.flush_timeout
+        deadline = time.time() + timeout
+        self._check_fork()
+        with self._condition:
+            if self._pending:
+                self._start()
+            while self._pending or self._writing:
+                if self._thread is None or not self._thread.is_alive():
+                    return False
+                left = deadline - time.time()
+                if left <= 0:
+                    return False
+                self._condition.wait(left)
+        return True
+
+    def _check_fork(self):
+        # Threads don't survive a fork, and one of them may have held the lock
+        # of the condition, so a child process starts afresh. The writes
+        # pending at the fork are left to the parent.
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._pending = OrderedDict()
+        self._writing = 0
+        self._condition = Condition()
+        self._thread = None
+
+    def _start(self):
+        # A thread that stopped on an error is replaced.
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = Thread(target=self._run, name='django-pylibmc-write-behind')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _take_batch(self):
+        with self._condition:
+            while not self._pending:
+                self._condition.wait()
+            batch = []
+            while self._pending and len(batch) < self.batch_size:
+                batch.append(self._pending.popitem(last=False))
+            self._writing = len(batch)
+        return batch
+
+    def _run(self):
+        try:
+            client = self.create_client()
+            while True:
+                self._write(client, self._take_batch())
+                with self._condition:
+                    self._writing = 0
+                    self._condition.notify_all()
+        except Exception as e:
+            # The next write or flush starts another thread.
+            log.error('Write-behind thread stopped: %s', e, exc_info=True)
+            with self._condition:
+                self._writing = 0
+                self._condition.notify_all()
+
+    def _write(self, client, batch):
+        groups = {}
+        for key, (value, timeout, compress_kwargs) in batch:
+            groups.setdefault((timeout, compress_kwargs), {})[key] = value
+        for (timeout, compress_kwargs), values in groups.items():
+            try:
+                client.set_multi(values, timeout, **dict(compress_kwargs))
+            except Exception as e:
+                # Neither memcached errors nor unpicklable values may stop
+                # the thread.
+                log.error('Write-behind failed: %s', e, exc_info=True)
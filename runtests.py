@@ -16,6 +16,11 @@ if __name__ == "__main__":
     os.environ['DJANGO_SETTINGS_MODULE'] = 'tests.settings'
     django.setup()
 
+    # Run against the stand-in instead of a memcached server
+    if '--fake-memcached' in sys.argv:
+        from tests.fake_memcached import FakeMemcachedServer
+        FakeMemcachedServer(port=11211).start()
+
     # Log memcache errors to console
     from django_pylibmc.memcached import log
     handler = logging.StreamHandler()
@@ -62,7 +62,12 @@ setup(
     author_email='jbalogh@mozilla.com',
     url='https://github.com/django-pylibmc/django-pylibmc',
     license='BSD',
-    packages=['django_pylibmc'],
+    packages=[
+        'django_pylibmc',
+        'django_pylibmc.management',
+        'django_pylibmc.management.commands',
+        'django_pylibmc.templatetags',
+    ],
     include_package_data=True,
     zip_safe=False,
     install_requires=['pylibmc>=1.4.1'],
@@ -0,0 +1,601 @@
+# -*- coding: utf-8 -*-
+"""
+A small in-process memcached stand-in for tests and benchmarks.
+
+It speaks enough of the text and binary protocols for pylibmc (get/gets,
+storage commands, delete, incr/decr, touch, flush_all, stats, version and
+SASL), and can be programmed to misbehave:
+
+- ``latency``: seconds to wait before answering each request. Either a
+  number, a ``(low, high)`` tuple for a uniform distribution, or a callable
+  taking a ``random.Random`` instance and returning seconds.
+- ``reset_rate``: probability of resetting the connection instead of
+  answering a request.
+- ``partial_rate``: probability of sending only half of a response and then
+  closing the connection.
+- ``max_item_size``: largest value accepted, in bytes (memcached's ``-I``).
+
+All of these can be changed while the server is running::
+
+    with FakeMemcachedServer() as server:
+        server.latency = (0.01, 0.05)
+        client = pylibmc.Client([server.location])
+"""
+from __future__ import unicode_literals
+
+import random
+import socket
+import struct
+import threading
+import time
+
+try:
+    import socketserver
+except ImportError:
+    # Python 2
+    import SocketServer as socketserver
+
+
+# memcached treats expiration times above 30 days as Unix timestamps
+MAX_RELATIVE_EXPTIME = 60 * 60 * 24 * 30
+
+# Binary protocol
+REQUEST_MAGIC = 0x80
+RESPONSE_MAGIC = 0x81
+HEADER = struct.Struct('!BBHBBHIIQ')
+
+STATUS_OK = 0x00
+STATUS_KEY_NOT_FOUND = 0x01
+STATUS_KEY_EXISTS = 0x02
+STATUS_VALUE_TOO_LARGE = 0x03
+STATUS_INVALID_ARGUMENTS = 0x04
+STATUS_NOT_STORED = 0x05
+STATUS_NON_NUMERIC = 0x06
+STATUS_UNKNOWN_COMMAND = 0x81
+
+OP_GET, OP_SET, OP_ADD, OP_REPLACE, OP_DELETE = 0x00, 0x01, 0x02, 0x03, 0x04
+OP_INCR, OP_DECR, OP_QUIT, OP_FLUSH, OP_GETQ = 0x05, 0x06, 0x07, 0x08, 0x09
+OP_NOOP, OP_VERSION, OP_GETK, OP_GETKQ = 0x0a, 0x0b, 0x0c, 0x0d
+OP_APPEND, OP_PREPEND, OP_STAT = 0x0e, 0x0f, 0x10
+OP_SETQ, OP_ADDQ, OP_REPLACEQ, OP_DELETEQ = 0x11, 0x12, 0x13, 0x14
+OP_INCRQ, OP_DECRQ, OP_QUITQ, OP_FLUSHQ = 0x15, 0x16, 0x17, 0x18
+OP_APPENDQ, OP_PREPENDQ, OP_TOUCH = 0x19, 0x1a, 0x1c
+OP_SASL_LIST, OP_SASL_AUTH = 0x20, 0x21
+
+QUIET_OPS = {
+    OP_GETQ: OP_GET, OP_GETKQ: OP_GETK, OP_SETQ: OP_SET, OP_ADDQ: OP_ADD,
+    OP_REPLACEQ: OP_REPLACE, OP_DELETEQ: OP_DELETE, OP_INCRQ: OP_INCR,
+    OP_DECRQ: OP_DECR, OP_QUITQ: OP_QUIT, OP_FLUSHQ: OP_FLUSH,
+    OP_APPENDQ: OP_APPEND, OP_PREPENDQ: OP_PREPEND,
+}
+
+STORAGE_OPS = {
+    OP_SET: 'set', OP_ADD: 'add', OP_REPLACE: 'replace',
+    OP_APPEND: 'append', OP_PREPEND: 'prepend',
+}
+
+
+class ConnectionDropped(Exception):
+    pass
+
+
+class Store(object):
+    """
+    The item storage, shared by every connection to a server.
+    """
+
+    def __init__(self, max_item_size):
+        self.max_item_size = max_item_size
+        self.lock = threading.Lock()
+        self.items = {}
+        self.next_cas = 1
+        self.started = time.time()
+        self.stats = dict.fromkeys((
+            'cmd_get', 'cmd_set', 'cmd_touch', 'get_hits', 'get_misses',
+            'delete_hits', 'delete_misses', 'incr_hits', 'incr_misses',
+            'decr_hits', 'decr_misses', 'evictions', 'total_connections',
+        ), 0)
+        self.curr_connections = 0
+
+    def _expires_at(self, exptime):
+        if exptime == 0:
+            return None
+        if exptime < 0:
+            return 0
+        if exptime > MAX_RELATIVE_EXPTIME:
+            return exptime
+        return time.time() + exptime
+
+    def _live(self, key):
+        item = self.items.get(key)
+        if item is None:
+            return None
+        expires_at = item[1]
+        if expires_at is not None and expires_at <= time.time():
+            del self.items[key]
+            return None
+        return item
+
+    def _store(self, key, flags, exptime, value):
+        self.items[key] = (flags, self._expires_at(exptime), self.next_cas, value)
+        self.next_cas += 1
+
+    def get(self, key):
+        with self.lock:
+            self.stats['cmd_get'] += 1
+            item = self._live(key)
+            self.stats['get_hits' if item else 'get_misses'] += 1
+            if item is None:
+                return None
+            flags, _, cas, value = item
+            return flags, cas, value
+
+    def store(self, command, key, flags, exptime, value, cas=0):
+        """
+        Returns one of 'STORED', 'NOT_STORED', 'EXISTS', 'NOT_FOUND' or
+        'TOO_LARGE'.
+        """
+        with self.lock:
+            self.stats['cmd_set'] += 1
+            if len(value) > self.max_item_size:
+                # Like memcached, a failed set evicts the previous value.
+                self.items.pop(key, None)
+                return 'TOO_LARGE'
+            item = self._live(key)
+            if command == 'add' and item is not None:
+                return 'NOT_STORED'
+            if command in ('replace', 'append', 'prepend') and item is None:
+                return 'NOT_STORED'
+            if cas:
+                if item is None:
+                    return 'NOT_FOUND'
+                if item[2] != cas:
+                    return 'EXISTS'
+            if command == 'append':
+                flags, value = item[0], item[3] + value
+            elif command == 'prepend':
+                flags, value = item[0], value + item[3]
+            self._store(key, flags, exptime, value)
+            return 'STORED'
+
+    def delete(self, key):
+        with self.lock:
+            found = self._live(key) is not None
+            self.items.pop(key, None)
+            self.stats['delete_hits' if found else 'delete_misses'] += 1
+            return found
+
+    def incr(self, key, delta, decr=False, initial=None, exptime=0):
+        """
+        Returns the new value, None if the key doesn't exist or False if the
+        stored value isn't numeric.
+        """
+        prefix = 'decr_' if decr else 'incr_'
+        with self.lock:
+            item = self._live(key)
+            if item is None:
+                self.stats[prefix + 'misses'] += 1
+                if initial is None:
+                    return None
+                self._store(key, 0, exptime, str(initial).encode('ascii'))
+                return initial
+            self.stats[prefix + 'hits'] += 1
+            try:
+                current = int(item[3])
+            except ValueError:
+                return False
+            if decr:
+                new = max(current - delta, 0)
+            else:
+                new = (current + delta) % 2 ** 64
+            self.items[key] = (item[0], item[1], self.next_cas, str(new).encode('ascii'))
+            self.next_cas += 1
+            return new
+
+    def touch(self, key, exptime):
+        with self.lock:
+            self.stats['cmd_touch'] += 1
+            item = self._live(key)
+            if item is None:
+                return False
+            self.items[key] = (item[0], self._expires_at(exptime), item[2], item[3])
+            return True
+
+    def flush(self):
+        with self.lock:
+            self.items.clear()
+
+    def get_stats(self, group):
+        with self.lock:
+            if group == b'slabs':
+                return self._slab_stats()
+            if group == b'items':
+                return self._item_stats()
+            stats = [
+                ('pid', 0),
+                ('uptime', int(time.time() - self.started)),
+                ('time', int(time.time())),
+                ('version', FakeMemcachedServer.version),
+                ('curr_connections', self.curr_connections),
+                ('curr_items', len(self.items)),
+                ('bytes', sum(len(item[3]) for item in self.items.values())),
+                ('limit_maxbytes', 64 * 1024 * 1024),
+                ('item_size_max', self.max_item_size),
+            ]
+            stats.extend(sorted(self.stats.items()))
+            return stats
+
+    def _slab_stats(self):
+        # A single slab class holding everything is good enough for tests.
+        used = len(self.items)
+        chunk_size = max([len(item[3]) for item in self.items.values()] or [96])
+        return [
+            ('1:chunk_size', chunk_size),
+            ('1:chunks_per_page', max(1024 * 1024 // chunk_size, 1)),
+            ('1:total_pages', 1),
+            ('1:total_chunks', max(used, 1)),
+            ('1:used_chunks', used),
+            ('active_slabs', 1),
+            ('total_malloced', chunk_size * used),
+        ]
+
+    def _item_stats(self):
+        return [
+            ('items:1:number', len(self.items)),
+            ('items:1:evicted', self.stats['evictions']),
+        ]
+
+
+class FakeMemcachedHandler(socketserver.BaseRequestHandler):
+
+    def setup(self):
+        self.buffer = b''
+        self.store = self.server.store
+        with self.store.lock:
+            self.store.curr_connections += 1
+            self.store.stats['total_connections'] += 1
+
+    def finish(self):
+        with self.store.lock:
+            self.store.curr_connections -= 1
+
+    def handle(self):
+        try:
+            first = self.read_exactly(1)
+            self.buffer = first + self.buffer
+            if ord(first[:1]) == REQUEST_MAGIC:
+                self.handle_binary()
+            else:
+                self.handle_text()
+        except (ConnectionDropped, socket.error):
+            pass
+
+    # I/O helpers
+
+    def fill(self):
+        data = self.request.recv(65536)
+        if not data:
+            raise ConnectionDropped()
+        self.buffer += data
+
+    def read_line(self):
+        while b'\r\n' not in self.buffer:
+            self.fill()
+        line, self.buffer = self.buffer.split(b'\r\n', 1)
+        return line
+
+    def read_exactly(self, size):
+        while len(self.buffer) < size:
+            self.fill()
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def before_response(self):
+        """
+        Apply the configured faults before answering a request.
+        """
+        server = self.server.owner
+        delay = server.sample_latency()
+        if delay:
+            time.sleep(delay)
+        if server.should('reset_rate'):
+            # SO_LINGER with a zero timeout makes close() send a RST.
+            self.request.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                    struct.pack('ii', 1, 0))
+            self.request.close()
+            raise ConnectionDropped()
+
+    def send(self, data):
+        if data and self.server.owner.should('partial_rate'):
+            self.request.sendall(data[:max(len(data) // 2, 1)])
+            self.request.close()
+            raise ConnectionDropped()
+        self.request.sendall(data)
+
+    # Text protocol
+
+    def handle_text(self):
+        while True:
+            line = self.read_line()
+            parts = line.split()
+            if not parts:
+                self.before_response()
+                self.send(b'ERROR\r\n')
+                continue
+            command = parts[0].decode('ascii', 'replace').lower()
+            args = parts[1:]
+            noreply = bool(args) and args[-1] == b'noreply'
+            if noreply:
+                args = args[:-1]
+            if command in ('set', 'add', 'replace', 'append', 'prepend', 'cas'):
+                # Always consume the data block, even for malformed commands.
+                size = int(args[3]) if len(args) > 3 and args[3].isdigit() else 0
+                data = self.read_exactly(size + 2)[:-2]
+            else:
+                data = None
+            if command == 'quit':
+                return
+            self.before_response()
+            response = self.text_command(command, args, data)
+            if not noreply:
+                self.send(response)
+
+    def text_command(self, command, args, data):
+        store = self.store
+        try:
+            if command in ('get', 'gets'):
+                out = []
+                for key in args:
+                    item = store.get(key)
+                    if item is None:
+                        continue
+                    flags, cas, value = item
+                    header = b'VALUE ' + key + (' %d %d' % (flags, len(value))).encode('ascii')
+                    if command == 'gets':
+                        header += (' %d' % cas).encode('ascii')
+                    out.append(header + b'\r\n' + value + b'\r\n')
+                out.append(b'END\r\n')
+                return b''.join(out)
+            if command in ('set', 'add', 'replace', 'append', 'prepend', 'cas'):
+                key, flags, exptime = args[0], int(args[1]), int(args[2])
+                cas = int(args[4]) if command == 'cas' else 0
+                result = store.store('set' if command == 'cas' else command,
+                                     key, flags, exptime, data, cas)
+                if result == 'TOO_LARGE':
+                    return b'SERVER_ERROR object too large for cache\r\n'
+                return result.encode('ascii') + b'\r\n'
+            if command == 'delete':
+                return b'DELETED\r\n' if store.delete(args[0]) else b'NOT_FOUND\r\n'
+            if command in ('incr', 'decr'):
+                result = store.incr(args[0], int(args[1]), decr=command == 'decr')
+                if result is None:
+                    return b'NOT_FOUND\r\n'
+                if result is False:
+                    return b'CLIENT_ERROR cannot increment or decrement non-numeric value\r\n'
+                return ('%d\r\n' % result).encode('ascii')
+            if command == 'touch':
+                return b'TOUCHED\r\n' if store.touch(args[0], int(args[1])) else b'NOT_FOUND\r\n'
+            if command == 'flush_all':
+                store.flush()
+                return b'OK\r\n'
+            if command == 'stats':
+                stats = store.get_stats(args[0] if args else None)
+                return b''.join(
+                    ('STAT %s %s\r\n' % (name, value)).encode('ascii') for name, value in stats
+                ) + b'END\r\n'
+            if command == 'version':
+                return ('VERSION %s\r\n' % FakeMemcachedServer.version).encode('ascii')
+            if command == 'verbosity':
+                return b'OK\r\n'
+        except (IndexError, ValueError):
+            return b'CLIENT_ERROR bad command line format\r\n'
+        return b'ERROR\r\n'
+
+    # Binary protocol
+
+    def handle_binary(self):
+        while True:
+            header = self.read_exactly(HEADER.size)
+            (magic, opcode, key_length, extras_length, _, _, body_length,
+             opaque, cas) = HEADER.unpack(header)
+            if magic != REQUEST_MAGIC:
+                return
+            body = self.read_exactly(body_length)
+            extras = body[:extras_length]
+            key = body[extras_length:extras_length + key_length]
+            value = body[extras_length + key_length:]
+            quiet = opcode in QUIET_OPS
+            command = QUIET_OPS.get(opcode, opcode)
+            if command == OP_QUIT:
+                if not quiet:
+                    self.before_response()
+                    self.send(self.binary_response(opcode, opaque))
+                return
+            self.before_response()
+            responses = self.binary_command(command, opcode, quiet, key, extras, value, opaque, cas)
+            if responses:
+                self.send(b''.join(responses))
+
+    def binary_response(self, opcode, opaque, status=STATUS_OK, key=b'',
+                        extras=b'', value=b'', cas=0):
+        body_length = len(extras) + len(key) + len(value)
+        return HEADER.pack(RESPONSE_MAGIC, opcode, len(key), len(extras), 0,
+                           status, body_length, opaque, cas) + extras + key + value
+
+    def binary_command(self, command, opcode, quiet, key, extras, value, opaque, cas):
+        store = self.store
+        respond = self.binary_response
+
+        if command in (OP_GET, OP_GETK):
+            item = store.get(key)
+            if item is None:
+                if quiet:
+                    return []
+                return [respond(opcode, opaque, STATUS_KEY_NOT_FOUND, value=b'Not found')]
+            flags, item_cas, data = item
+            return [respond(opcode, opaque, key=key if command == OP_GETK else b'',
+                            extras=struct.pack('!I', flags), value=data, cas=item_cas)]
+
+        if command in STORAGE_OPS:
+            if command in (OP_APPEND, OP_PREPEND):
+                flags, exptime = 0, 0
+            else:
+                flags, exptime = struct.unpack('!Ii', extras)
+            result = store.store(STORAGE_OPS[command], key, flags, exptime, value, cas)
+            status = {
+                'STORED': STATUS_OK,
+                'NOT_STORED': STATUS_KEY_EXISTS if command == OP_ADD else STATUS_NOT_STORED,
+                'EXISTS': STATUS_KEY_EXISTS,
+                'NOT_FOUND': STATUS_KEY_NOT_FOUND,
+                'TOO_LARGE': STATUS_VALUE_TOO_LARGE,
+            }[result]
+            if status == STATUS_OK and quiet:
+                return []
+            return [respond(opcode, opaque, status)]
+
+        if command == OP_DELETE:
+            if store.delete(key):
+                return [] if quiet else [respond(opcode, opaque)]
+            return [respond(opcode, opaque, STATUS_KEY_NOT_FOUND)]
+
+        if command in (OP_INCR, OP_DECR):
+            delta, initial, exptime = struct.unpack('!QQI', extras)
+            if exptime == 0xffffffff:
+                initial = None
+            result = store.incr(key, delta, decr=command == OP_DECR,
+                                initial=initial, exptime=exptime)
+            if result is None:
+                return [respond(opcode, opaque, STATUS_KEY_NOT_FOUND)]
+            if result is False:
+                return [respond(opcode, opaque, STATUS_NON_NUMERIC)]
+            if quiet:
+                return []
+            return [respond(opcode, opaque, value=struct.pack('!Q', result))]
+
+        if command == OP_TOUCH:
+            exptime, = struct.unpack('!i', extras)
+            if store.touch(key, exptime):
+                return [respond(opcode, opaque)]
+            return [respond(opcode, opaque, STATUS_KEY_NOT_FOUND)]
+
+        if command == OP_FLUSH:
+            store.flush()
+            return [] if quiet else [respond(opcode, opaque)]
+
+        if command == OP_NOOP:
+            return [respond(opcode, opaque)]
+
+        if command == OP_VERSION:
+            return [respond(opcode, opaque, value=FakeMemcachedServer.version.encode('ascii'))]
+
+        if command == OP_STAT:
+            responses = [
+                respond(opcode, opaque, key=str(name).encode('ascii'),
+                        value=str(stat).encode('ascii'))
+                for name, stat in store.get_stats(key or None)
+            ]
+            responses.append(respond(opcode, opaque))
+            return responses
+
+        if command == OP_SASL_LIST:
+            return [respond(opcode, opaque, value=b'PLAIN')]
+
+        if command == OP_SASL_AUTH:
+            return [respond(opcode, opaque, value=b'Authenticated')]
+
+        return [respond(opcode, opaque, STATUS_UNKNOWN_COMMAND)]
+
+
+class _ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class FakeMemcachedServer(object):
+    """
+    A memcached stand-in listening on ``host:port`` (a free port by default).
+    """
+    version = '1.5.0-fake'
+
+    def __init__(self, host='127.0.0.1', port=0, latency=None, reset_rate=0.0,
+                 partial_rate=0.0, max_item_size=1024 * 1024, seed=None):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.reset_rate = reset_rate
+        self.partial_rate = partial_rate
+        self.random = random.Random(seed)
+        self.store = Store(max_item_size)
+        self._server = None
+        self._thread = None
+
+    @property
+    def max_item_size(self):
+        return self.store.max_item_size
+
+    @max_item_size.setter
+    def max_item_size(self, value):
+        self.store.max_item_size = value
+
+    @property
+    def location(self):
+        return '%s:%d' % (self.host, self.port)
+
+    def sample_latency(self):
+        latency = self.latency
+        if not latency:
+            return 0
+        if callable(latency):
+            return latency(self.random)
+        if isinstance(latency, (tuple, list)):
+            return self.random.uniform(*latency)
+        return latency
+
+    def should(self, fault):
+        rate = getattr(self, fault)
+        return rate > 0 and self.random.random() < rate
+
+    def reset_faults(self):
+        self.latency = None
+        self.reset_rate = 0.0
+        self.partial_rate = 0.0
+
+    def start(self):
+        self._server = _ThreadedTCPServer((self.host, self.port), FakeMemcachedHandler)
+        self._server.store = self.store
+        self._server.owner = self
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=11211)
+    parser.add_argument('--max-item-size', type=int, default=1024 * 1024)
+    args = parser.parse_args()
+    server = FakeMemcachedServer(args.host, args.port, max_item_size=args.max_item_size).start()
+    print('Listening on %s' % server.location)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
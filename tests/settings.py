@@ -7,6 +7,7 @@ DATABASES = {
 }
 
 INSTALLED_APPS = (
+    'django_pylibmc',
     'tests',
 )
 
@@ -28,6 +29,46 @@ CACHES = {
             'ketama': True
         }
     },
+    'negative': {
+        'BACKEND': 'django_pylibmc.memcached.PyLibMCCache',
+        'LOCATION': '127.0.0.1:11211',
+        'NEGATIVE_TIMEOUT': 60,
+        'LOCAL_MISS_FILTER': 100,
+    },
+    'adaptive': {
+        'BACKEND': 'django_pylibmc.memcached.PyLibMCCache',
+        'LOCATION': '127.0.0.1:11211',
+        'ADAPTIVE_COMPRESSION': {
+            'min_samples': 2,
+        },
+    },
+    'hot_keys': {
+        'BACKEND': 'django_pylibmc.memcached.PyLibMCCache',
+        'LOCATION': '127.0.0.1:11211',
+        'HOT_KEYS': {
+            'sample_rate': 1,
+            'capacity': 10,
+        },
+    },
+    'write_behind': {
+        'BACKEND': 'django_pylibmc.memcached.PyLibMCCache',
+        'LOCATION': '127.0.0.1:11211',
+        'WRITE_BEHIND': True,
+    },
+    'compress': {
+        'BACKEND': 'django_pylibmc.memcached.PyLibMCCache',
+        'LOCATION': '127.0.0.1:11211',
+        'MIN_COMPRESS_LEN': 1024,
+        'COMPRESS_LEVEL': 9,
+    },
+    'migrate': {
+        'BACKEND': 'django_pylibmc.memcached.PyLibMCCache',
+        'LOCATION': '127.0.0.1:11211',
+        'MIGRATE_FROM': {
+            'location': '127.0.0.1:11212',
+            'until': 4102444800,  # 2100-01-01
+        },
+    },
 
 }
 
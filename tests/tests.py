@@ -2,16 +2,34 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
 import time
+import zlib
 from unittest import skipIf
 
 import django
 from django.core import signals
-from django.core.cache import caches
+from django.core.cache import InvalidCacheBackendError, caches
+from django.core.management import call_command
+from django.core.cache.utils import make_template_fragment_key
 from django.db import close_old_connections
-from django.test import TestCase
+from django.template import Context, Engine, TemplateSyntaxError
+from django.test import TestCase, override_settings
 from django.utils import six
 
+from django_pylibmc import deadlines, memcached, stats
+from django_pylibmc.compression import AdaptiveCompression
+from django_pylibmc.fragments import FragmentBatch
+from django_pylibmc.hotkeys import SpaceSaving
+from django_pylibmc.middleware import CacheDeadlineMiddleware
+from django_pylibmc.writebehind import WriteBehindQueue
+
+from .fake_memcached import FakeMemcachedServer
 from .models import Poll, expensive_calculation
 
 try:
@@ -554,6 +572,190 @@ class PylibmcCacheTests(TestCase):
         super_big_value = 'x' * 400 * 1024 * 1024
         self.assertFalse(self.cache.set('super_big_value', super_big_value))
 
+    def test_get_or_set_negative_timeout(self):
+        loader = mock.Mock(return_value=None)
+        self.assertIsNone(self.cache.get_or_set('missing', loader, negative_timeout=60))
+        self.assertIsNone(self.cache.get_or_set('missing', loader, negative_timeout=60))
+        self.assertEqual(loader.call_count, 1)
+        # The remembered miss isn't visible as a value
+        self.assertIsNone(self.cache.get('missing'))
+        self.assertNotIn('missing', self.cache)
+        self.assertDictEqual(self.cache.get_many(['missing']), {})
+        self.assertTrue(self.cache.add('missing', 'found'))
+        self.assertEqual(self.cache.get_or_set('missing', loader, negative_timeout=60), 'found')
+
+    def test_get_or_load_many(self):
+        self.cache.set('a', 'a')
+        loader = mock.Mock(return_value={'b': 'b'})
+        self.assertDictEqual(self.cache.get_or_load_many(['a', 'b', 'c'], loader), {'a': 'a', 'b': 'b'})
+        loader.assert_called_once_with(['b', 'c'])
+        self.assertEqual(self.cache.get('b'), 'b')
+        self.assertIsNone(self.cache.get('c'))
+
+    def test_get_or_load_many_negative_timeout(self):
+        loader = mock.Mock(return_value={'a': 'a'})
+        self.cache.get_or_load_many(['a', 'b'], loader, negative_timeout=60)
+        self.assertDictEqual(self.cache.get_or_load_many(['a', 'b'], loader, negative_timeout=60), {'a': 'a'})
+        self.assertEqual(loader.call_count, 1)
+
+    def test_get_or_load_many_version(self):
+        self.cache.set('a', 'a1', version=1)
+        self.cache.set('a', 'a2', version=2)
+        self.cache.set('b', 'b2', version=2)
+        values = self.cache.get_or_load_many(['a', 'b'], lambda keys: {}, version={'a': 1, 'b': 2})
+        self.assertDictEqual(values, {'a': 'a1', 'b': 'b2'})
+        self.cache.get_or_load_many(['c'], lambda keys: {'c': 'c3'}, version=3)
+        self.assertEqual(self.cache.get('c', version=3), 'c3')
+
+    def test_get_or_load_many_waits_for_lock(self):
+        self.cache._cache.add(self.cache.make_key('b') + ':lock', 1, 10)
+        loader = mock.Mock(return_value={'a': 'a'})
+
+        def other_caller_loads(seconds):
+            self.cache.set('b', 'b')
+
+        with mock.patch('django_pylibmc.memcached.time.sleep', side_effect=other_caller_loads):
+            values = self.cache.get_or_load_many(['a', 'b'], loader, lock_timeout=10)
+        self.assertDictEqual(values, {'a': 'a', 'b': 'b'})
+        loader.assert_called_once_with(['a'])
+        # Our own lock was released
+        self.assertTrue(self.cache._cache.add(self.cache.make_key('a') + ':lock', 1, 10))
+
+    def test_get_or_load_many_lock_released_without_value(self):
+        lock = self.cache.make_key('a') + ':lock'
+        self.cache._cache.add(lock, 1, 10)
+        loader = mock.Mock(return_value={'a': 'a'})
+
+        def other_caller_loads_nothing(seconds):
+            self.cache._cache.delete(lock)
+
+        start = time.time()
+        with mock.patch('django_pylibmc.memcached.time.sleep', side_effect=other_caller_loads_nothing), \
+                mock.patch.object(self.cache._lib.Client, 'add_multi',
+                                  wraps=self.cache._cache.add_multi) as mock_add_multi:
+            values = self.cache.get_or_load_many(['a'], loader, lock_timeout=10)
+        self.assertDictEqual(values, {'a': 'a'})
+        self.assertLess(time.time() - start, 5)
+        # The key was locked again before it was loaded.
+        loader.assert_called_once_with(['a'])
+        self.assertEqual(mock_add_multi.call_count, 2)
+        self.assertTrue(self.cache._cache.add(lock, 1, 10))
+
+    def test_get_or_load_many_lock_ttl(self):
+        loader = mock.Mock(return_value={'a': 'a'})
+        for lock_timeout, ttl in ((0.1, 1), (1, 1), (2.5, 3)):
+            with mock.patch.object(self.cache._lib.Client, 'add_multi', return_value=[]) as mock_add_multi:
+                self.cache.get_or_load_many(['a'], loader, lock_timeout=lock_timeout)
+            mock_add_multi.assert_called_once_with({self.cache.make_key('a') + ':lock': 1}, ttl)
+            self.cache.delete('a')
+
+    def test_get_or_load_many_lock_expires(self):
+        self.cache._cache.add(self.cache.make_key('a') + ':lock', 1, 10)
+        loader = mock.Mock(return_value={'a': 'a'})
+        self.assertDictEqual(self.cache.get_or_load_many(['a'], loader, lock_timeout=0.1), {'a': 'a'})
+        loader.assert_called_once_with(['a'])
+
+    def test_server_stats(self):
+        self.cache.set('page:1', 'x' * 100)
+        self.cache.set('page:2', 'x' * 300)
+        self.cache.get('page:1')
+        self.cache.get('page:3')
+        server_stats = self.cache.server_stats(sample_keys=['page:1', 'page:2', 'page:3'])
+        server = server_stats['servers']['127.0.0.1:11211']
+        self.assertGreater(server['get_hits'], 0)
+        self.assertGreater(server['get_misses'], 0)
+        self.assertGreater(server['curr_items'], 0)
+        self.assertTrue(server['slabs'])
+        self.assertEqual(server_stats['ring']['curr_items'], server['curr_items'])
+        self.assertDictEqual(server_stats['namespaces'], {'page': {'samples': 2, 'avg_size': 200, 'max_size': 300}})
+
+    def test_budget(self):
+        self.cache.set('key', 'value')
+        self.cache.set_many({'key1': 'spam', 'key2': 'eggs'})
+        self.assertEqual(self.cache.get('key', budget=0.5), 'value')
+        self.assertDictEqual(self.cache.get_many(['key1', 'key2'], budget=0.5), {'key1': 'spam', 'key2': 'eggs'})
+        self.assertTrue(self.cache.set('key', 'new value', budget=0.5))
+        self.assertEqual(self.cache.get('key'), 'new value')
+        client = self.cache._client_within(0.5)
+        self.assertEqual(client.behaviors['receive_timeout'], 250000)
+        self.assertIs(self.cache._client_within(0.5), client)
+
+    def test_budget_too_small(self):
+        self.cache.set('key', 'value')
+        with mock.patch.object(self.cache._lib.Client, 'get') as mock_get:
+            self.assertEqual(self.cache.get('key', 'default', budget=0.001), 'default')
+            self.assertDictEqual(self.cache.get_many(['key'], budget=0.001), {})
+            self.assertFalse(self.cache.set('key', 'new value', budget=0.001))
+        self.assertFalse(mock_get.called)
+        self.assertEqual(self.cache.get('key'), 'value')
+
+    def test_iter_many(self):
+        data = {'key%d' % i: i for i in range(25)}
+        self.cache.set_many(data)
+        self.cache.set_many({'key0': 'other version'}, version=2)
+        keys = ('key%d' % i for i in range(30))
+        with mock.patch.object(self.cache._lib.Client, 'get_multi',
+                               side_effect=self.cache._cache.get_multi) as mock_get_multi:
+            items = self.cache.iter_many(keys, chunk_size=10)
+            self.assertEqual(next(items)[0], 'key0')
+            self.assertEqual(mock_get_multi.call_count, 1)
+            self.assertDictEqual(dict(items), {'key%d' % i: i for i in range(1, 25)})
+        self.assertEqual(mock_get_multi.call_count, 3)
+        self.assertTrue(all(len(call[0][0]) <= 10 for call in mock_get_multi.call_args_list))
+        self.assertEqual(list(self.cache.iter_many(['key0', 'key1'], version=2)), [('key0', 'other version')])
+
+    def test_iter_many_by_server(self):
+        made_keys = {self.cache.make_key(key): key for key in 'abcdef'}
+        with mock.patch.object(self.cache, '_servers', ['127.0.0.1:11211', '127.0.0.1:11212']), \
+                mock.patch.object(self.cache._lib.Client, 'hash', side_effect=lambda key: ord(key[-1]) % 2):
+            chunks = self.cache._server_chunks('abcdef', 2)
+        self.assertEqual([sorted(chunk.values()) for chunk in chunks],
+                         [['b', 'd'], ['a', 'c'], ['f'], ['e']])
+        for chunk in chunks:
+            self.assertTrue(all(made_keys[made_key] == key for made_key, key in chunk.items()))
+
+    def test_deadline(self):
+        self.cache.set('key', 'value')
+        with deadlines.deadline(0.5):
+            self.assertEqual(self.cache.get('key'), 'value')
+            with deadlines.deadline(0):
+                self.assertIsNone(self.cache.get('key'))
+                self.assertFalse(self.cache.set('key', 'new value'))
+            self.assertEqual(self.cache.get('key'), 'value')
+
+    def test_without_options(self):
+        # Django < 1.11 leaves _options as None for caches without OPTIONS.
+        cache = memcached.PyLibMCCache(self.cache._server, {
+            'KEY_PREFIX': 'no-options', 'HOT_KEYS': True, 'ADAPTIVE_COMPRESSION': True,
+            'LOCAL_MISS_FILTER': 10, 'WRITE_BEHIND': True,
+        })
+        cache._options = None
+        self.assertTrue(cache.set('key', 'value'))
+        self.assertTrue(cache.flush_writes())
+        self.assertFalse(cache.add('key', 'other value'))
+        self.assertEqual(cache.get_or_set('key', 'default'), 'value')
+        self.assertIsNotNone(cache.hot_keys())
+        with deadlines.deadline(0.5):
+            self.assertEqual(cache.get('key', budget=0.5), 'value')
+
+    def test_deadline_other_operations(self):
+        self.cache.set('key', 'value')
+        self.cache.set('counter', 1)
+        loader = mock.Mock(return_value={'other': 'loaded'})
+        with deadlines.deadline(0):
+            self.assertEqual(self.cache.get_or_set('key', 'default'), 'default')
+            self.assertEqual(self.cache.get_or_load_many(['other'], loader), {'other': 'loaded'})
+            self.assertFalse(self.cache.add('new', 'value'))
+            self.assertFalse(self.cache.delete('key'))
+            self.assertEqual(self.cache.set_many({'key': 'new value'}), ['key'])
+            with self.assertRaises(ValueError):
+                self.cache.incr('counter')
+        loader.assert_called_once_with(['other'])
+        self.assertEqual(self.cache.get('key'), 'value')
+        self.assertIsNone(self.cache.get('other'))
+        self.assertIsNone(self.cache.get('new'))
+        self.assertEqual(self.cache.get('counter'), 1)
+
 
 class PylibmcCacheWithBinaryTests(PylibmcCacheTests):
     cache_name = 'binary'
@@ -561,3 +763,640 @@ class PylibmcCacheWithBinaryTests(PylibmcCacheTests):
 
 class PylibmcCacheWithOptionsTests(PylibmcCacheTests):
     cache_name = 'with_options'
+
+
+class PylibmcNegativeCacheTests(TestCase):
+
+    def setUp(self):
+        self.cache = caches['negative']
+
+    def tearDown(self):
+        self.cache.clear()
+
+    def test_local_miss_filter(self):
+        self.assertIsNone(self.cache.get_or_set('missing', lambda: None))
+        with mock.patch.object(self.cache._lib.Client, 'get') as mock_get:
+            self.assertIsNone(self.cache.get_or_set('missing', lambda: None))
+            self.assertDictEqual(self.cache.get_or_load_many(['missing'], lambda keys: {}), {})
+        self.assertFalse(mock_get.called)
+
+    def test_add_replaces_miss_atomically(self):
+        self.assertIsNone(self.cache.get_or_set('missing', lambda: None))
+        self.cache._miss_filter.clear()
+        made_key = self.cache.make_key('missing')
+        client = self.cache._cas_client
+        real_gets = client.gets
+        results = []
+
+        def gets(key):
+            results.append(real_gets(key))
+            self.cache._cache.set(made_key, 'written meanwhile')
+            return results[-1]
+
+        with mock.patch.object(client, 'gets', side_effect=gets):
+            self.assertFalse(self.cache.add('missing', 'found'))
+        # The marker was read, and the write in between made cas fail.
+        self.assertEqual(len(results), 1)
+        self.assertTrue(memcached.is_miss(results[0][0]))
+        self.assertIsNotNone(results[0][1])
+        self.assertEqual(self.cache.get('missing'), 'written meanwhile')
+
+    def test_add_without_negative_caching(self):
+        cache = memcached.PyLibMCCache(self.cache._server, {'KEY_PREFIX': 'no-negative'})
+        cache.set('key', 'value')
+        with mock.patch.object(cache._lib.Client, 'gets') as mock_gets:
+            self.assertFalse(cache.add('key', 'new value'))
+        self.assertFalse(mock_gets.called)
+        cache.delete('key')
+
+    def test_set_clears_local_miss_filter(self):
+        self.assertIsNone(self.cache.get_or_set('missing', lambda: None))
+        self.cache.set('missing', 'found')
+        self.assertEqual(self.cache.get_or_set('missing', lambda: None), 'found')
+
+
+class LazyConfigurationTests(TestCase):
+
+    def test_import(self):
+        # Importing the backend neither imports pylibmc nor reads settings.
+        code = ('import sys; import django_pylibmc.memcached; from django.conf import settings; '
+                'print(\'pylibmc\' in sys.modules, settings.configured)')
+        env = dict(os.environ)
+        env.pop('DJANGO_SETTINGS_MODULE', None)
+        output = subprocess.check_output([sys.executable, '-c', code], env=env)
+        self.assertEqual(output.decode().split(), ['False', 'False'])
+
+    def test_compress_settings(self):
+        self.assertDictEqual(caches['default']._default_compress_kwargs,
+                             {'min_compress_len': 150 * 1024, 'compress_level': 1})
+        self.assertDictEqual(caches['compress']._default_compress_kwargs,
+                             {'min_compress_len': 1024, 'compress_level': 9})
+
+    def test_compress_settings_read_on_first_use(self):
+        cache = caches['default'].__class__('127.0.0.1:11211', {})
+        with override_settings(PYLIBMC_MIN_COMPRESS_LEN=2048):
+            self.assertEqual(cache._default_compress_kwargs['min_compress_len'], 2048)
+
+    def test_compressed(self):
+        cache = caches['compress']
+        value = 'x' * 4096
+        self.assertTrue(cache.set('compressed', value))
+        self.assertEqual(cache.get('compressed'), value)
+        cache.delete('compressed')
+
+
+class PylibmcMigrationTests(TestCase):
+
+    def setUp(self):
+        self.cache = caches['migrate']
+        self.old_cache = self.cache._local.old_client = mock.Mock()
+        self.old_cache.get_multi.return_value = {}
+
+    def tearDown(self):
+        self.cache.clear()
+        del self.cache._local.old_client
+
+    def test_get(self):
+        made_key = self.cache.make_key('key')
+        self.old_cache.get_multi.return_value = {made_key: 'old value'}
+        self.assertEqual(self.cache.get('key'), 'old value')
+        self.old_cache.get_multi.assert_called_once_with([made_key])
+        # The value was copied forward.
+        self.assertEqual(self.cache._cache.get(made_key), 'old value')
+        self.assertEqual(self.cache.get('key'), 'old value')
+        self.assertEqual(self.old_cache.get_multi.call_count, 1)
+
+    def test_get_missing(self):
+        self.assertEqual(self.cache.get('missing', 'default'), 'default')
+        self.assertIsNone(self.cache._cache.get(self.cache.make_key('missing')))
+
+    def test_writes_win(self):
+        made_key = self.cache.make_key('key')
+        self.cache.set('key', 'new value')
+        self.old_cache.get_multi.return_value = {made_key: 'old value'}
+        self.assertEqual(self.cache.get('key'), 'new value')
+        self.assertFalse(self.old_cache.get_multi.called)
+
+    def test_get_many(self):
+        self.cache.set('key1', 'new value')
+        self.old_cache.get_multi.return_value = {self.cache.make_key('key2'): 'old value'}
+        self.assertDictEqual(self.cache.get_many(['key1', 'key2', 'key3']),
+                             {'key1': 'new value', 'key2': 'old value'})
+        self.assertEqual(sorted(self.old_cache.get_multi.call_args[0][0]),
+                         [self.cache.make_key('key2'), self.cache.make_key('key3')])
+        self.assertDictEqual(dict(self.cache.iter_many(['key1', 'key2'])),
+                             {'key1': 'new value', 'key2': 'old value'})
+        self.assertDictEqual(self.cache.get_or_load_many(['key2', 'key3'], lambda keys: {'key3': 3}),
+                             {'key2': 'old value', 'key3': 3})
+
+    def test_incr(self):
+        self.old_cache.get_multi.return_value = {self.cache.make_key('counter'): 41}
+        self.assertEqual(self.cache.incr('counter'), 42)
+        self.old_cache.get_multi.return_value = {}
+        with self.assertRaises(ValueError):
+            self.cache.decr('missing')
+
+    def test_delete(self):
+        self.cache.delete('key')
+        self.old_cache.delete_multi.assert_called_once_with([self.cache.make_key('key')])
+        self.cache.delete_many(['key1', 'key2'])
+        self.old_cache.delete_multi.assert_called_with([self.cache.make_key('key1'), self.cache.make_key('key2')])
+
+    def test_clear(self):
+        self.cache.clear()
+        self.assertTrue(self.old_cache.flush_all.called)
+
+    def test_set_deletes_old(self):
+        self.cache.set('key', 'value')
+        self.old_cache.delete_multi.assert_called_once_with([self.cache.make_key('key')])
+        self.cache.set_many({'key1': 1, 'key2': 2})
+        self.assertEqual(sorted(self.old_cache.delete_multi.call_args[0][0]),
+                         [self.cache.make_key('key1'), self.cache.make_key('key2')])
+
+    def test_budget(self):
+        made_key = self.cache.make_key('key')
+        # The old servers are read with a client that fits in the budget.
+        old_client = mock.Mock()
+        old_client.get_multi.return_value = {made_key: 'old value'}
+        self.cache._local.deadline_clients = {(0.05, True): old_client}
+        try:
+            self.assertEqual(self.cache.get('key', budget=0.1), 'old value')
+            self.assertFalse(self.old_cache.get_multi.called)
+            self.assertEqual(self.cache._cache.get(made_key), 'old value')
+            self.assertIsNone(self.cache.get('other', budget=0.001))
+            self.assertEqual(old_client.get_multi.call_count, 1)
+        finally:
+            del self.cache._local.deadline_clients
+
+    def test_window(self):
+        params = {'MIGRATE_FROM': {'location': '127.0.0.1:11212', 'window': 3600}}
+        with self.assertRaises(InvalidCacheBackendError):
+            memcached.PyLibMCCache(self.cache._server, params)
+        params['MIGRATE_FROM']['start'] = time.time() - 3601
+        self.assertIsNone(memcached.PyLibMCCache(self.cache._server, params)._old_cache)
+        params['MIGRATE_FROM']['start'] = time.time() - 3599
+        self.assertIsNotNone(memcached.PyLibMCCache(self.cache._server, params)._old_cache)
+
+    def test_ended(self):
+        with mock.patch.object(self.cache, '_migration', dict(self.cache._migration, until=time.time() - 1)):
+            self.assertIsNone(self.cache.get('key'))
+        self.assertFalse(self.old_cache.get_multi.called)
+
+
+class FragmentBatchTests(TestCase):
+
+    def setUp(self):
+        self.cache = caches['default']
+        self.engine = Engine(libraries={'pylibmc_fragments': 'django_pylibmc.templatetags.pylibmc_fragments'})
+
+    def tearDown(self):
+        self.cache.clear()
+
+    def render(self, template, **context):
+        return self.engine.from_string('{% load pylibmc_fragments %}' + template).render(Context(context))
+
+    def test_batch(self):
+        self.cache.set('cached', 'cached fragment')
+        batch = FragmentBatch(self.cache)
+        output = '%s, %s, %s' % (batch.add('cached', lambda: 'rendered'),
+                                 batch.add('missing', lambda: 'new fragment', 60),
+                                 batch.add('cached', lambda: 'rendered'))
+        with mock.patch.object(self.cache, 'get_many', wraps=self.cache.get_many) as mock_get_many:
+            self.assertEqual(batch.render(output), 'cached fragment, new fragment, cached fragment')
+        self.assertEqual(mock_get_many.call_count, 1)
+        self.assertEqual(self.cache.get('missing'), 'new fragment')
+        self.assertTrue(batch.closed)
+
+    def test_template(self):
+        template = ('{% fragment_batch %}'
+                    '{% for item in items %}'
+                    '{% batched_cache 60 item item %}{{ forloop.counter }}={{ item }}{% endbatched_cache %};'
+                    '{% endfor %}'
+                    '{% endfragment_batch %}')
+        with mock.patch.object(self.cache, 'get') as mock_get, \
+                mock.patch.object(self.cache, 'get_many', wraps=self.cache.get_many) as mock_get_many:
+            self.assertEqual(self.render(template, items=['a', 'b', 'c']), '1=a;2=b;3=c;')
+        self.assertFalse(mock_get.called)
+        self.assertEqual(mock_get_many.call_count, 1)
+        # The keys are those of Django's {% cache %}.
+        self.assertEqual(self.cache.get(make_template_fragment_key('item', ['b'])), '2=b')
+        self.assertEqual(self.render(template, items=['c', 'b', 'd']), '3=c;2=b;3=d;')
+
+    def test_without_batch(self):
+        template = '{% batched_cache 60 greeting name %}Hello {{ name }}{% endbatched_cache %}'
+        self.assertEqual(self.render(template, name='World'), 'Hello World')
+        self.assertEqual(self.render(template + '!', name='World'), 'Hello World!')
+        self.assertEqual(self.cache.get(make_template_fragment_key('greeting', ['World'])), 'Hello World')
+
+    def test_nested(self):
+        template = ('{% fragment_batch %}'
+                    '{% batched_cache 60 outer %}<{% batched_cache 60 inner %}{{ value }}{% endbatched_cache %}>'
+                    '{% endbatched_cache %}'
+                    '{% endfragment_batch %}')
+        self.assertEqual(self.render(template, value='x'), '<x>')
+        self.assertEqual(self.cache.get(make_template_fragment_key('inner')), 'x')
+        self.assertEqual(self.render(template, value='y'), '<x>')
+
+    def test_changed_placeholders(self):
+        batch = FragmentBatch(self.cache)
+        placeholder = batch.add('key', lambda: 'value')
+        for output in (placeholder.upper(), placeholder[:-1], placeholder + placeholder.upper()):
+            self.assertFalse(batch.is_intact(output))
+            with self.assertRaises(ValueError):
+                batch.render(output)
+        self.assertIsNone(self.cache.get('key'))
+        for tag_filter in ('upper', 'slugify', 'truncatechars:20'):
+            template = ('{% fragment_batch %}{% filter ' + tag_filter + ' %}'
+                        '{% batched_cache 60 fragment %}{{ value }}{% endbatched_cache %}'
+                        '{% endfilter %}{% endfragment_batch %}')
+            self.assertEqual(self.render(template, value='Some value'),
+                             self.engine.from_string('{% filter ' + tag_filter + ' %}Some value{% endfilter %}')
+                             .render(Context()))
+            self.assertEqual(self.cache.get(make_template_fragment_key('fragment')), 'Some value')
+            self.cache.clear()
+
+    def test_using(self):
+        template = ('{% fragment_batch using="binary" %}'
+                    '{% batched_cache 60 fragment using="default" %}value{% endbatched_cache %}'
+                    '{% endfragment_batch %}')
+        with mock.patch.object(self.cache, 'get', return_value=None) as mock_get:
+            self.assertEqual(self.render(template), 'value')
+        self.assertTrue(mock_get.called)
+        with self.assertRaises(TemplateSyntaxError):
+            self.render('{% fragment_batch using="missing" %}{% endfragment_batch %}')
+        with self.assertRaises(TemplateSyntaxError):
+            self.render('{% fragment_batch 60 %}{% endfragment_batch %}')
+
+
+class FaultInjectionTests(TestCase):
+
+    def setUp(self):
+        self.server = FakeMemcachedServer(seed=0).start()
+        self.cache = self.make_cache(self.server)
+        self.assertTrue(self.cache.set('key', 'value'))
+
+    def tearDown(self):
+        self.server.stop()
+
+    def make_cache(self, server, **params):
+        # Retry failed servers after a second instead of two.
+        params.setdefault('OPTIONS', {'retry_timeout': 1})
+        return memcached.PyLibMCCache(server.location, params)
+
+    def test_latency(self):
+        self.server.latency = (0.01, 0.02)
+        start = time.time()
+        self.assertEqual(self.cache.get('key'), 'value')
+        self.assertGreaterEqual(time.time() - start, 0.01)
+
+    def test_latency_over_budget(self):
+        self.server.latency = 0.5
+        start = time.time()
+        self.assertEqual(self.cache.get('key', 'default', budget=0.1), 'default')
+        self.assertDictEqual(self.cache.get_many(['key'], budget=0.1), {})
+        self.assertFalse(self.cache.set('key', 'new value', budget=0.1))
+        self.assertLess(time.time() - start, 1.0)
+
+    def test_connection_reset(self):
+        self.server.reset_rate = 1
+        self.assertEqual(self.cache.get('key', 'default'), 'default')
+        self.assertDictEqual(self.cache.get_many(['key']), {})
+        self.assertDictEqual(dict(self.cache.iter_many(['key'])), {})
+        self.assertFalse(self.cache.set('key', 'new value'))
+        self.assertFalse(self.cache.add('other key', 'value'))
+
+    def test_recovery(self):
+        self.server.reset_rate = 1
+        self.assertIsNone(self.cache.get('key'))
+        self.server.reset_faults()
+        deadline = time.time() + 5
+        while self.cache.get('key') is None and time.time() < deadline:
+            time.sleep(0.1)
+        self.assertEqual(self.cache.get('key'), 'value')
+
+    def test_partial_response(self):
+        self.server.partial_rate = 1
+        self.assertEqual(self.cache.get('key', 'default'), 'default')
+        self.assertDictEqual(self.cache.get_many(['key']), {})
+        self.assertFalse(self.cache.set('key', 'new value'))
+
+    def test_item_too_large(self):
+        self.server.max_item_size = 1024
+        self.assertFalse(self.cache.set('large', os.urandom(4096)))
+        self.assertFalse(self.cache.add('large', os.urandom(4096)))
+        self.assertIsNone(self.cache.get('large'))
+        self.assertEqual(self.cache.get('key'), 'value')
+
+    def test_migration(self):
+        with FakeMemcachedServer() as new_server:
+            cache = self.make_cache(new_server, MIGRATE_FROM={'location': self.server.location})
+            self.assertEqual(cache.get('key'), 'value')
+            self.server.reset_rate = 1
+            self.assertEqual(cache.get('key'), 'value')
+            self.assertDictEqual(cache.get_many(['key', 'missing']), {'key': 'value'})
+
+
+class AdaptiveCompressionTests(TestCase):
+
+    def setUp(self):
+        self.compression = AdaptiveCompression(1024, zlib.Z_DEFAULT_COMPRESSION, sample_rate=0,
+                                               min_samples=3, levels=[(1024 * 1024, zlib.Z_BEST_SPEED)])
+
+    def test_compressible(self):
+        for i in range(5):
+            kwargs = self.compression.compress_kwargs('page', 'x' * 4096)
+        self.assertDictEqual(kwargs, {'min_compress_len': 1024, 'compress_level': zlib.Z_DEFAULT_COMPRESSION})
+
+    def test_incompressible(self):
+        for i in range(2):
+            kwargs = self.compression.compress_kwargs('thumbnail', os.urandom(4096))
+        # Not enough samples to decide
+        self.assertEqual(kwargs['min_compress_len'], 1024)
+        kwargs = self.compression.compress_kwargs('thumbnail', os.urandom(4096))
+        self.assertDictEqual(kwargs, {'min_compress_len': 0})
+        # Other namespaces and types are still compressed
+        self.assertEqual(self.compression.compress_kwargs('thumbnail', 'x' * 4096)['min_compress_len'], 1024)
+        self.assertEqual(self.compression.compress_kwargs('page', b'x' * 4096)['min_compress_len'], 1024)
+
+    def test_small_and_uncompressed_values(self):
+        self.assertDictEqual(self.compression.compress_kwargs('page', 'x'), {'min_compress_len': 0})
+        self.assertDictEqual(self.compression.compress_kwargs('page', 42), {'min_compress_len': 0})
+
+    def test_max_kinds(self):
+        compression = AdaptiveCompression(1024, zlib.Z_DEFAULT_COMPRESSION, max_kinds=1)
+        compression.compress_kwargs('page', 'x' * 4096)
+        with mock.patch('django_pylibmc.compression.zlib.compress') as mock_compress:
+            for i in range(100):
+                kwargs = compression.compress_kwargs('other', 'x' * 4096)
+        self.assertFalse(mock_compress.called)
+        self.assertDictEqual(kwargs, {'min_compress_len': 1024, 'compress_level': zlib.Z_DEFAULT_COMPRESSION})
+        self.assertEqual(list(compression.stats()), [('page', six.text_type.__name__)])
+
+    def test_level_by_size(self):
+        kwargs = self.compression.compress_kwargs('page', 'x' * 2 * 1024 * 1024)
+        self.assertEqual(kwargs['compress_level'], zlib.Z_BEST_SPEED)
+        # Pickled values use the average size of their kind
+        kwargs = self.compression.compress_kwargs('pages', ['x' * 2 * 1024 * 1024])
+        self.assertEqual(kwargs['compress_level'], zlib.Z_BEST_SPEED)
+
+    def test_stats(self):
+        for i in range(3):
+            self.compression.compress_kwargs('thumbnail', os.urandom(4096))
+            self.compression.compress_kwargs('page', 'x' * 4096)
+        stats = self.compression.stats()
+        thumbnails = stats[('thumbnail', six.binary_type.__name__)]
+        self.assertIs(thumbnails['compress'], False)
+        self.assertIsNone(thumbnails['level'])
+        pages = stats[('page', six.text_type.__name__)]
+        self.assertIs(pages['compress'], True)
+        self.assertEqual(pages['samples'], 3)
+        self.assertEqual(pages['size'], 4096)
+
+
+class PylibmcAdaptiveCompressionTests(TestCase):
+
+    def setUp(self):
+        self.cache = caches['adaptive']
+
+    def tearDown(self):
+        self.cache.clear()
+
+    def test_set_and_get(self):
+        thumbnail = os.urandom(200 * 1024)
+        for i in range(3):
+            self.cache.set('thumbnail:%d' % i, thumbnail)
+            self.cache.set('page:%d' % i, 'x' * 200 * 1024)
+        self.assertEqual(self.cache.get('thumbnail:1'), thumbnail)
+        self.assertEqual(self.cache.get('page:1'), 'x' * 200 * 1024)
+        stats = self.cache.compression_stats()
+        self.assertIs(stats[('thumbnail', six.binary_type.__name__)]['compress'], False)
+        self.assertIs(stats[('page', six.text_type.__name__)]['compress'], True)
+
+    def test_disabled(self):
+        self.assertIsNone(caches['default'].compression_stats())
+
+
+class ServerStatsTests(TestCase):
+
+    def test_parse_server(self):
+        self.assertEqual(stats.parse_server('10.0.0.1:11212'), (socket.AF_INET, ('10.0.0.1', 11212)))
+        self.assertEqual(stats.parse_server('cache'), (socket.AF_INET, ('cache', 11211)))
+        self.assertEqual(stats.parse_server('[::1]:11212'), (socket.AF_INET, ('::1', 11212)))
+        self.assertEqual(stats.parse_server('/tmp/memcached.sock'), (socket.AF_UNIX, '/tmp/memcached.sock'))
+        self.assertEqual(stats.parse_server('/tmp/memcached.sock:0'), (socket.AF_UNIX, '/tmp/memcached.sock'))
+
+    def test_ring_summary(self):
+        slabs = {
+            '1:chunk_size': '96', '1:total_chunks': '100', '1:used_chunks': '50', 'active_slabs': '1',
+        }
+        items = {'items:1:number': '50', 'items:1:evicted': '3'}
+        server = stats.server_summary(
+            {'get_hits': b'3', 'get_misses': b'1', 'bytes': b'10', 'limit_maxbytes': b'100', 'evictions': b'3'},
+            stats.slab_classes(slabs, items))
+        self.assertEqual(server['hit_ratio'], 0.75)
+        self.assertEqual(server['slabs'][1]['fill'], 0.5)
+        ring = stats.ring_summary({'a': server, 'b': server})
+        self.assertEqual(ring['evictions'], 6)
+        self.assertEqual(ring['memory_fill'], 0.1)
+        self.assertEqual(ring['slabs'][1]['total_chunks'], 200)
+        self.assertEqual(ring['slabs'][1]['evicted'], 6)
+
+    def test_command(self):
+        out = six.StringIO()
+        call_command('memcached_stats', sample_keys=['page:1'], stdout=out)
+        self.assertIn('127.0.0.1:11211', out.getvalue())
+        self.assertIn('hit ratio', out.getvalue())
+
+    def test_command_json(self):
+        out = six.StringIO()
+        call_command('memcached_stats', json=True, stdout=out)
+        self.assertIn('127.0.0.1:11211', json.loads(out.getvalue())['servers'])
+
+
+class SpaceSavingTests(TestCase):
+
+    def test_top(self):
+        summary = SpaceSaving(3)
+        for item in 'aaaabbbcdd':
+            summary.add(item)
+        self.assertEqual(len(summary), 3)
+        # "d" replaced "c" and inherited its count as error
+        self.assertEqual(summary.top(), [('a', 4, 0), ('b', 3, 0), ('d', 3, 1)])
+        self.assertEqual(summary.top(1), [('a', 4, 0)])
+
+
+class PylibmcHotKeysTests(TestCase):
+
+    def setUp(self):
+        self.cache = caches['hot_keys']
+        self.cache._hot_key_sampler.clear()
+
+    def tearDown(self):
+        self.cache.clear()
+
+    def test_hot_keys(self):
+        for i in range(5):
+            self.cache.get('page:home')
+        self.cache.set('page:about', 'about')
+        self.cache.get_many(['page:home', 'user:1'])
+
+        report = self.cache.hot_keys(limit=2)
+        self.assertEqual(report['sampled'], 8)
+        self.assertDictEqual(report['keys'][0], {
+            'key': self.cache.make_key('page:home'),
+            'count': 6,
+            'error': 0,
+            'server': '127.0.0.1:11211',
+        })
+        self.assertEqual(len(report['keys']), 2)
+        self.assertDictEqual(report['namespaces'][0], {'namespace': 'page', 'count': 7, 'error': 0})
+
+    def test_disabled(self):
+        self.assertIsNone(caches['default'].hot_keys())
+
+
+class DeadlineTests(TestCase):
+
+    def tearDown(self):
+        deadlines.clear_deadline()
+
+    def test_remaining(self):
+        self.assertIsNone(deadlines.remaining())
+        self.assertEqual(deadlines.remaining(0.1), 0.1)
+        with deadlines.deadline(10):
+            self.assertAlmostEqual(deadlines.remaining(), 10, places=1)
+            self.assertEqual(deadlines.remaining(0.1), 0.1)
+            # Nested deadlines can only shorten the outer one
+            with deadlines.deadline(20):
+                self.assertLessEqual(deadlines.remaining(), 10)
+        self.assertIsNone(deadlines.remaining())
+
+    def test_middleware(self):
+        middleware = CacheDeadlineMiddleware()
+        with self.settings(PYLIBMC_REQUEST_DEADLINE=0.2):
+            middleware.process_request(None)
+            self.assertAlmostEqual(deadlines.remaining(), 0.2, places=1)
+        response = object()
+        self.assertIs(middleware.process_response(None, response), response)
+        self.assertIsNone(deadlines.remaining())
+
+
+class WriteBehindQueueTests(TestCase):
+
+    def setUp(self):
+        self.writing = threading.Event()
+        self.blocked = threading.Event()
+        self.client = mock.Mock()
+
+        def set_multi(values, timeout, **kwargs):
+            self.writing.set()
+            self.blocked.wait(5)
+
+        self.client.set_multi.side_effect = set_multi
+        self.queue = WriteBehindQueue(lambda: self.client, max_pending=2, batch_size=10)
+
+    def tearDown(self):
+        self.blocked.set()
+
+    def block_writes(self):
+        self.queue.put({'first': 0}, 60, {})
+        self.writing.wait(5)
+        self.client.set_multi.reset_mock()
+
+    def test_batches_and_coalesces(self):
+        self.block_writes()
+        self.queue.put({'a': 1}, 60, {})
+        self.queue.put({'a': 2, 'b': 3}, 60, {})
+        self.blocked.set()
+        self.assertTrue(self.queue.flush())
+        self.client.set_multi.assert_called_once_with({'a': 2, 'b': 3}, 60)
+
+    def test_groups_by_arguments(self):
+        self.block_writes()
+        self.queue.put({'a': 1}, 60, {})
+        self.queue.put({'b': 2}, 60, {'min_compress_len': 10})
+        self.blocked.set()
+        self.assertTrue(self.queue.flush())
+        self.client.set_multi.assert_has_calls([
+            mock.call({'a': 1}, 60),
+            mock.call({'b': 2}, 60, min_compress_len=10),
+        ], any_order=True)
+
+    def test_drops_when_full(self):
+        self.block_writes()
+        self.assertEqual(self.queue.put({'a': 1, 'b': 2}, 60, {}), [])
+        self.assertEqual(self.queue.put({'a': 3, 'c': 4}, 60, {}), ['c'])
+        self.assertEqual(self.queue.dropped, 1)
+
+    def test_discard(self):
+        self.block_writes()
+        self.queue.put({'a': 1, 'b': 2}, 60, {})
+        self.queue.discard(['a'])
+        self.assertEqual(len(self.queue), 1)
+        self.blocked.set()
+        self.assertTrue(self.queue.flush())
+        self.client.set_multi.assert_called_once_with({'b': 2}, 60)
+
+    def test_restarts_stopped_thread(self):
+        create_client = mock.Mock(side_effect=[Exception('no client'), self.client])
+        self.blocked.set()
+        queue = WriteBehindQueue(create_client)
+        queue.put({'a': 1}, 60, {})
+        queue._thread.join(5)
+        self.assertFalse(queue._thread.is_alive())
+        self.assertTrue(queue.flush())
+        self.client.set_multi.assert_called_once_with({'a': 1}, 60)
+
+    def test_fork(self):
+        self.block_writes()
+        self.queue.put({'a': 1}, 60, {})
+        condition = self.queue._condition
+        condition.acquire()
+        try:
+            # The child neither waits for the lock held in the parent nor
+            # does its writes.
+            with mock.patch('os.getpid', return_value=-1):
+                self.assertEqual(len(self.queue), 0)
+                self.assertIsNot(self.queue._condition, condition)
+                self.assertTrue(self.queue.flush())
+        finally:
+            condition.release()
+
+
+class PylibmcWriteBehindTests(TestCase):
+
+    def setUp(self):
+        self.cache = caches['write_behind']
+
+    def tearDown(self):
+        self.cache.clear()
+
+    def test_set(self):
+        self.assertTrue(self.cache.set('key', 'value'))
+        self.assertEqual(self.cache.set_many({'key1': 'spam', 'key2': 'eggs'}), [])
+        self.assertTrue(self.cache.flush_writes())
+        self.assertEqual(self.cache.get('key'), 'value')
+        self.assertDictEqual(self.cache.get_many(['key1', 'key2']), {'key1': 'spam', 'key2': 'eggs'})
+
+    def test_close_doesnt_wait(self):
+        with mock.patch.object(WriteBehindQueue, 'flush') as flush:
+            self.cache.set('key', 'value')
+            self.cache.close()
+        self.assertFalse(flush.called)
+
+    def test_queue_per_settings(self):
+        # Caches with the same servers but other settings have their own queue.
+        queue = self.cache._write_behind_queue
+        other = memcached.PyLibMCCache(self.cache._server, {'WRITE_BEHIND': {'max_pending': 5}, 'BINARY': True})
+        self.assertIsNot(other._write_behind_queue, queue)
+        self.assertEqual(other._write_behind_queue.max_pending, 5)
+        self.assertEqual(queue.max_pending, 10000)
+        same = memcached.PyLibMCCache(self.cache._server, {'WRITE_BEHIND': True})
+        self.assertIs(same._write_behind_queue, queue)
+
+    def test_delete_discards_pending_write(self):
+        self.cache.set('key', 'value')
+        self.cache.delete('key')
+        self.assertEqual(len(self.cache._write_behind_queue), 0)
+        self.assertTrue(self.cache.flush_writes())
+        self.assertIsNone(self.cache.get('key'))